@@ -1,10 +1,12 @@
 # action_handler.py
-from PyQt5.QtWidgets import QInputDialog, QFileDialog, QMessageBox, QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QLineEdit, QTableWidgetItem, QColorDialog, QTableWidget
+import os
+from PyQt5.QtWidgets import QInputDialog, QFileDialog, QMessageBox, QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QLineEdit, QTableWidgetItem, QColorDialog, QTableWidget, QProgressDialog
 from PyQt5.QtGui import QColor
+from PyQt5.QtCore import Qt, QEventLoop, QThreadPool
 import pandas as pd
 import data_model
 import file_io
-import re
+import csv_import
 
 class TiersDialog(QDialog):
     def __init__(self, parent, is_min_threshold=True, current_tiers=[], mode="numeric"):
@@ -205,6 +207,7 @@ class ActionHandler:
         self.main.remove_btn.clicked.connect(self.remove_selected)
         self.main.set_formula_action.triggered.connect(self.set_column_formula)
         self.main.score_tiers_action.triggered.connect(self.set_column_tiers)
+        self.main.undo_memory_action.triggered.connect(self.change_undo_memory)
 
     def set_column_formula(self):
         numeric_cols = [col for col, typ in self.main.data_model.column_types.items() if typ in ["integer", "float", "boolean"]]
@@ -218,7 +221,6 @@ class ActionHandler:
             if ok2:
                 try:
                     self.main.data_model.set_column_formula(col, f)
-                    self.main.refresh_table()
                     self.main.update_chart()
                     self.main.change_view(self.main.current_view)
                 except ValueError as e:
@@ -289,23 +291,44 @@ class ActionHandler:
                     self.main.data_model.set_column_tiers(col, tier_mode, tiers)
                     self.main.data_model.save_to_history()
                     self.main.update_legends()
-                    self.main.refresh_table()
                     self.main.update_chart()
                     self.main.change_view(self.main.current_view)
 
+    def change_undo_memory(self):
+        size, ok = QInputDialog.getInt(self.main, "Change Undo Memory Limit", "Undo history memory limit (MB):", self.main.undo_memory_mb, 1, 65536, 64)
+        if ok:
+            self.main.undo_memory_mb = size
+            self.main.apply_undo_limit()
+
     def save_session_manually(self):
-        file_io.save_multi(self.main.data_models, data_model.DataModel.SESSION_FILE)
-        QMessageBox.information(self.main, "Save Successful", "Session saved.")
+        # Written in the background; the status bar shows progress and the
+        # result, failures come up as a warning
+        self.main.statusBar().showMessage("Saving session...")
+        self.main.journal.save(self.main.data_models)
 
     def undo(self):
-        if self.main.data_model.undo():
-            self.main.refresh_table()
-            self.main.update_chart()
-            self.main.update_legends()
-            self.main.change_view(self.main.current_view)
+        if self.main.data_models.undo() is not None:
+            self.after_history_change()
         else:
             QMessageBox.warning(self.main, "Undo", "No more actions to undo.")
 
+    def redo(self):
+        if self.main.data_models.redo() is not None:
+            self.after_history_change()
+        else:
+            QMessageBox.warning(self.main, "Redo", "No more actions to redo.")
+
+    def after_history_change(self):
+        # The shown page's table already followed the change notifications;
+        # only a different page (the shown one was removed) needs a rebuild
+        shown = self.main.data_model
+        self.main.sync_pages()
+        if self.main.data_model is not shown:
+            self.main.refresh_table()
+        self.main.update_chart()
+        self.main.update_legends()
+        self.main.change_view(self.main.current_view)
+
     def add_page(self):
         name, ok = QInputDialog.getText(self.main, "Add Page", "Page Name:")
         if ok and name:
@@ -314,13 +337,10 @@ class ActionHandler:
                 return
             dm = data_model.DataModel()
             dm.page_name = name
-            dm.all_data_models = self.main.data_models
-            self.main.data_models.append(dm)
+            self.main.data_models.add_page(dm)
             self.main.page_selector.addItem(name)
             self.main.page_selector.setCurrentText(name)
             self.main.change_page(self.main.page_selector.currentIndex())
-            for existing_dm in self.main.data_models:
-                existing_dm.all_data_models = self.main.data_models
 
     def rename_page(self):
         old_name = self.main.data_model.page_name
@@ -329,16 +349,8 @@ class ActionHandler:
             if new_name in [dm.page_name for dm in self.main.data_models]:
                 QMessageBox.warning(self.main, "Duplicate Name", "Page name already exists.")
                 return
-            for dm in self.main.data_models:
-                for c, f in list(dm.column_formulas.items()):
-                    new_f = f.replace(f"{{{old_name}:", f"{{{new_name}:")
-                    if new_f != f:
-                        dm.column_formulas[c] = new_f
-                        dm.column_formula_refs[c] = set(re.findall(r'\{(.*?)\}', new_f))
-                dm.recompute_all_computed()
-            self.main.data_model.page_name = new_name
+            self.main.data_models.rename_page(self.main.data_model, new_name)
             self.main.page_selector.setItemText(self.main.current_page, new_name)
-            self.main.refresh_table()
             self.main.update_chart()
 
     def delete_page(self):
@@ -347,22 +359,17 @@ class ActionHandler:
             return
         reply = QMessageBox.question(self.main, "Confirm Delete", f"Are you sure you want to delete page '{self.main.data_model.page_name}'?", QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         if reply == QMessageBox.Yes:
-            del_name = self.main.data_model.page_name
-            del self.main.data_models[self.main.current_page]
+            self.main.data_models.remove_page(self.main.current_page)
             self.main.page_selector.removeItem(self.main.current_page)
             self.main.current_page = min(self.main.current_page, len(self.main.data_models) - 1)
             self.main.page_selector.setCurrentIndex(self.main.current_page)
             self.main.change_page(self.main.current_page)
-            for dm in self.main.data_models:
-                dm.all_data_models = self.main.data_models
-                dm.recompute_all_computed()
 
     def add_model(self):
         model = self.main.model_input.text()
         try:
             self.main.data_model.add_model(model)
             self.main.model_input.clear()
-            self.main.refresh_table()
             self.main.update_chart()
         except ValueError as e:
             QMessageBox.warning(self.main, "Invalid Input", str(e))
@@ -374,7 +381,6 @@ class ActionHandler:
             if ok2:
                 try:
                     self.main.data_model.add_column(name, typ)
-                    self.main.refresh_table()
                     self.main.update_chart()
                 except ValueError as e:
                     QMessageBox.warning(self.main, "Duplicate Name", str(e))
@@ -387,18 +393,6 @@ class ActionHandler:
             if ok2 and new_name and new_name != old_name:
                 try:
                     self.main.data_model.rename_column(old_name, new_name)
-                    page_name = self.main.data_model.page_name
-                    for dm in self.main.data_models:
-                        for c, f in list(dm.column_formulas.items()):
-                            new_f = f.replace(f"{{{page_name}:{old_name}}}", f"{{{page_name}:{new_name}}}")
-                            if dm.page_name == page_name:
-                                new_f = new_f.replace(f"{{{old_name}}}", f"{{{new_name}}}")
-                            if new_f != f:
-                                dm.column_formulas[c] = new_f
-                                dm.column_formula_refs[c] = set(re.findall(r'\{(.*?)\}', new_f))
-                        dm.recompute_all_computed()
-                        dm.save_to_history()
-                    self.main.refresh_table()
                     self.main.update_chart()
                     self.main.update_legends()
                 except ValueError as e:
@@ -410,35 +404,31 @@ class ActionHandler:
         if ok:
             new_typ, ok2 = QInputDialog.getItem(self.main, "Change Type", "New Type:", ["string", "integer", "float", "boolean"], 0, False)
             if ok2:
-                self.main.data_model.change_column_type(col, new_typ)
-                self.main.refresh_table()
+                dm = self.main.data_model
+                report = dm.preview_column_type(col, new_typ)
+                if report.failed_count():
+                    examples = [f"{dm.df[dm.model_col_name].iat[r]}: {dm.df[col].iat[r]}" for r in report.failed_rows[:10]]
+                    more = f"\n... and {report.failed_count() - 10} more" if report.failed_count() > 10 else ""
+                    reply = QMessageBox.question(self.main, "Change Type", f"{report.failed_count()} of {len(dm.df)} values can't be converted to {new_typ} and will be left empty:\n\n" + "\n".join(examples) + more + "\n\nChange the type anyway?", QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+                    if reply != QMessageBox.Yes:
+                        return
+                dm.change_column_type(col, new_typ, report)
                 self.main.update_chart()
 
     def remove_selected(self):
-        selected_visual_rows = set(i.row() for i in self.main.table.selectedItems())
-        if selected_visual_rows:
-            selected_df_rows = []
-            try:
-                model_col = self.main.data_model.df.columns.get_loc(self.main.data_model.model_col_name)
-                for visual_row in selected_visual_rows:
-                    model_item = self.main.table.item(visual_row, model_col)
-                    if model_item:
-                        df_row = model_item.data(self.main.DF_ROW_ROLE)
-                        if df_row is not None:
-                            selected_df_rows.append(df_row)
-            except:
-                pass
-            if selected_df_rows:
-                self.main.data_model.remove_rows(selected_df_rows)
-                self.main.refresh_table()
-                self.main.update_chart()
+        rows = self.main.table_handler.selected_rows()
+        if rows:
+            self.main.table_handler.remove_rows(rows)
+            self.main.update_chart()
 
     def import_data(self):
         path, _ = QFileDialog.getOpenFileName(self.main, "Import Data", "", "Data Files (*.csv *.xlsx)")
         if path:
             # Get df
             if path.endswith('.csv'):
-                df = file_io.import_df(path)
+                df = self.read_csv(path)
+                if df is None:
+                    return
             else:
                 xls = pd.ExcelFile(path)
                 sheets = [s for s in xls.sheet_names if s != 'Metadata']
@@ -452,37 +442,79 @@ class ActionHandler:
                 else:
                     sheet = sheets[0]
                 df = pd.read_excel(xls, sheet_name=sheet)
-                df = df.fillna('')
             # Ask for page
             page_name, ok = QInputDialog.getText(self.main, "Import to Page", "Enter page name (existing or new):")
             if ok and page_name:
                 existing = [dm for dm in self.main.data_models if dm.page_name == page_name]
                 if existing:
                     dm = existing[0]
-                    dm.df = df
-                    dm.set_column_types()
-                    dm.recompute_all_computed()
-                    dm.save_to_history()
+                    modes = ["Update matching models, keep the rest", "Update matching models, remove the rest", "Replace the page"]
+                    mode, ok = QInputDialog.getItem(self.main, "Import to Page", f"Page {page_name} exists. Merge by model name:", modes, 0, False)
+                    if not ok:
+                        return
+                    if mode == modes[2]:
+                        # The batch recomputes every computed column
+                        # afterwards, in the background when the pages are
+                        # large
+                        with dm.batch():
+                            dm.replace_data(df)
+                    else:
+                        try:
+                            report = dm.upsert_data(df, remove_missing=mode == modes[1])
+                        except ValueError as e:
+                            QMessageBox.warning(self.main, "Import Failed", str(e))
+                            return
+                        self.show_upsert_report(report)
                 else:
                     dm = data_model.DataModel()
                     dm.page_name = page_name
                     dm.df = df
                     dm.set_column_types()
-                    dm.recompute_all_computed()
-                    dm.save_to_history()
-                    self.main.data_models.append(dm)
+                    dm.reindex_rows()
+                    self.main.data_models.add_page(dm)
                     self.main.page_selector.addItem(page_name)
-                dm.all_data_models = self.main.data_models
-                for other_dm in self.main.data_models:
-                    other_dm.all_data_models = self.main.data_models
-                    other_dm.recompute_all_computed()
                 if page_name == self.main.data_model.page_name:
-                    self.main.refresh_table()
                     self.main.update_chart()
 
+    def show_upsert_report(self, report):
+        lines = [f"{report.inserted} inserted, {report.updated} updated, {report.unchanged} unchanged"]
+        if report.removed:
+            lines.append(f"{report.removed} removed")
+        if report.failed:
+            lines.append("Left as they were (values didn't fit the column type): " + ", ".join(f"{col} ({count})" for col, count in report.failed.items()))
+        if report.skipped:
+            lines.append("Computed columns not imported: " + ", ".join(report.skipped))
+        QMessageBox.information(self.main, "Import Complete", "\n".join(lines))
+
+    def read_csv(self, path):
+        # Streamed on a worker thread behind a progress dialog; None when
+        # cancelled or unreadable
+        reader = csv_import.CsvImport(path)
+        signals = csv_import.CsvImportSignals()
+        dialog = QProgressDialog(f"Importing {os.path.basename(path)}...", "Cancel", 0, 1000, self.main)
+        dialog.setWindowModality(Qt.WindowModal)
+        dialog.setAutoClose(False)
+        dialog.setAutoReset(False)
+        dialog.canceled.connect(reader.cancel)
+        loop = QEventLoop()
+        result = {}
+        signals.progress.connect(lambda done, total: dialog.setValue(1000 * done // max(total, 1)))
+        signals.done.connect(lambda df: (result.update(df=df), loop.quit()))
+        signals.failed.connect(lambda message: (result.update(error=message), loop.quit()))
+        QThreadPool.globalInstance().start(csv_import.CsvImportJob(reader, signals))
+        loop.exec_()
+        dialog.close()
+        if 'error' in result:
+            QMessageBox.warning(self.main, "Import Failed", f"Could not read {path}: {result['error']}")
+            return None
+        if reader.widened:
+            QMessageBox.information(self.main, "Import", "Some values further down the file didn't match the type detected from its first rows, so these columns were imported as text: " + ", ".join(reader.widened))
+        return result.get('df')
+
     def export_session(self):
         path, _ = QFileDialog.getSaveFileName(self.main, "Export Session", "", "CSV Files (*.csv);;Excel Files (*.xlsx)")
         if path:
+            self.main.data_models.runner.settle()
             if path.endswith('.xlsx'):
                 file_io.save_multi(self.main.data_models, path)
                 QMessageBox.information(self.main, "Export Successful", f"All pages saved to {path}")
@@ -498,7 +530,6 @@ class ActionHandler:
             if reply == QMessageBox.Yes:
                 try:
                     self.main.data_model.delete_column(col)
-                    self.main.refresh_table()
                     self.main.update_chart()
                 except ValueError as e:
                     QMessageBox.warning(self.main, "Error", str(e))
\ No newline at end of file
@@ -13,6 +13,9 @@ class ChartHandler:
         self.main.change_view(view)
 
     def update_chart(self):
+        # Only drawn while shown; change_view draws it when switching to it
+        if self.main.current_view != "Chart":
+            return
         chart_type = self.main.chart_type_selector.currentText()
         title_fontsize = self.main.chart_base_font_size + 2
         tick_fontsize = self.main.chart_base_font_size - 1
@@ -37,9 +40,9 @@ class ChartHandler:
         x = range(len(sorted_df))
         y = list(range(len(sorted_df)))[::-1]  # for horizontal bars
 
-        values_dict = {col: sorted_df[col] for col in plot_cols}
+        values_dict = {col: sorted_df[col].to_numpy(dtype=float, na_value=float('nan')) for col in plot_cols}
         colors_dict = {
-            col: [self.main.data_model.get_column_color(col, v).name() for v in values_dict[col]]
+            col: [style.name for style in self.main.data_model.tier_styles(col, sorted_df[col])]
             for col in plot_cols
         }
         has_colors_dict = {col: col in self.main.data_model.column_tiers for col in plot_cols}
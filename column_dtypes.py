@@ -0,0 +1,151 @@
+# column_dtypes.py
+import numpy as np
+import pandas as pd
+
+# Storage dtype of each column type; all nullable so gaps stay missing
+# instead of turning the column into boxed objects
+DTYPES = {
+    "string": "string",
+    "integer": "Int64",
+    "float": "Float64",
+    "boolean": "boolean",
+}
+
+DEFAULTS = {
+    "string": '',
+    "integer": 0,
+    "float": 0.0,
+    "boolean": False,
+}
+
+SAMPLE_SIZE = 1000
+
+
+def sample(series):
+    # Evenly spaced non-missing values, at most SAMPLE_SIZE of them
+    values = series.dropna()
+    if len(values) > SAMPLE_SIZE:
+        values = values.iloc[np.linspace(0, len(values) - 1, SAMPLE_SIZE).astype(np.int64)]
+    return values
+
+
+def is_integral(values):
+    values = values[~np.isnan(values)]
+    return bool(np.isfinite(values).all() and np.array_equal(values, np.trunc(values)))
+
+
+def infer_type(series):
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return "boolean"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "integer"
+    if pd.api.types.is_float_dtype(dtype):
+        values = series.to_numpy(dtype=float, na_value=np.nan)
+        if np.isnan(values).all():
+            return "string"
+        return "integer" if is_integral(values) else "float"
+    if dtype != object:
+        return "string"
+    # Mixed object column: decide from a sample, then check the whole column
+    # converts without losing anything
+    values = sample(series)
+    if values.empty:
+        return "string"
+    kinds = values.map(type)
+    if kinds.isin([bool, np.bool_]).all():
+        typ = "boolean"
+    elif kinds.map(lambda t: issubclass(t, (int, float, np.number)) and not issubclass(t, (bool, np.bool_))).all():
+        typ = "float"
+    else:
+        return "string"
+    converted = convert(series, typ)
+    if converted is None or converted.isna().sum() != series.isna().sum():
+        return "string"
+    if typ == "float" and is_integral(converted.to_numpy(dtype=float, na_value=np.nan)):
+        return "integer"
+    return typ
+
+
+def convert(series, typ):
+    try:
+        if typ in ("integer", "float") and not pd.api.types.is_numeric_dtype(series.dtype):
+            series = pd.to_numeric(series, errors='coerce')
+        return series.astype(DTYPES[typ])
+    except (TypeError, ValueError):
+        return None
+
+
+def typed_series(series, typ):
+    converted = convert(series, typ)
+    if converted is None:
+        # Values that don't fit the type (e.g. 1.5 in an integer column) keep
+        # the nearest wider type
+        converted = convert(series, "float" if typ == "integer" else "string")
+    return converted
+
+
+def filled(typ, length, index=None):
+    return pd.Series([DEFAULTS[typ]] * length, index=index, dtype=DTYPES[typ])
+
+
+def changed_mask(old, new):
+    old = pd.Series(pd.array(old) if not isinstance(old, pd.Series) else old).reset_index(drop=True)
+    new = pd.Series(pd.array(new) if not isinstance(new, pd.Series) else new).reset_index(drop=True)
+    same = old.eq(new).fillna(False).to_numpy(dtype=bool) | (old.isna().to_numpy() & new.isna().to_numpy())
+    return ~same
+
+
+TRUE_STRINGS = {'true', 't', 'yes', 'y', '1'}
+FALSE_STRINGS = {'false', 'f', 'no', 'n', '0', ''}
+
+
+class ConversionReport:
+    # Outcome of converting one column: the converted values plus the rows
+    # whose values couldn't be converted and were left missing
+    def __init__(self, col, new_typ, values, failed):
+        self.col = col
+        self.new_typ = new_typ
+        self.values = values
+        self.failed_rows = np.flatnonzero(failed)
+
+    def failed_count(self):
+        return len(self.failed_rows)
+
+
+def coerce(series, typ):
+    # Whole-column conversion to typ; returns the converted series and a mask
+    # of values that were present but didn't survive
+    present = series.notna().to_numpy()
+    if typ == "string":
+        return series.astype(DTYPES["string"]), np.zeros(len(series), dtype=bool)
+    if typ == "boolean":
+        if pd.api.types.is_bool_dtype(series.dtype) or pd.api.types.is_numeric_dtype(series.dtype):
+            values = pd.array(series.to_numpy(dtype=float, na_value=np.nan), dtype=DTYPES["float"])
+            result = pd.Series(values != 0, index=series.index, dtype=DTYPES["boolean"])
+        else:
+            text = series.astype(DTYPES["string"]).str.strip().str.lower()
+            result = pd.Series(pd.NA, index=series.index, dtype=DTYPES["boolean"])
+            result[text.isin(TRUE_STRINGS).fillna(False).to_numpy(dtype=bool)] = True
+            result[text.isin(FALSE_STRINGS).fillna(False).to_numpy(dtype=bool)] = False
+        return result, present & result.isna().to_numpy()
+    if pd.api.types.is_bool_dtype(series.dtype):
+        numbers = series.astype(DTYPES["float"]).to_numpy(dtype=float, na_value=np.nan)
+    elif pd.api.types.is_numeric_dtype(series.dtype):
+        numbers = series.to_numpy(dtype=float, na_value=np.nan)
+    else:
+        text = series.astype(DTYPES["string"]).str.strip()
+        present = present & (text != '').fillna(False).to_numpy(dtype=bool)  # blanks are just missing
+        numbers = pd.to_numeric(text, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    if typ == "integer":
+        numbers[~(np.abs(numbers) < 2.0 ** 63)] = np.nan
+        numbers = np.trunc(numbers)
+    result = pd.Series(pd.array(numbers, dtype=DTYPES["float"]), index=series.index)
+    if typ == "integer":
+        result = result.astype(DTYPES["integer"])
+    return result, present & np.isnan(numbers)
+
+
+def convert_column(series, col, typ):
+    values, failed = coerce(series, typ)
+    return ConversionReport(col, typ, values, failed)
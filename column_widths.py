@@ -0,0 +1,148 @@
+# column_widths.py
+import numpy as np
+from PyQt5.QtWidgets import QStyle
+
+# Longest values (by character count) measured with the font per column
+SAMPLE = 5
+
+
+def display_lengths(series):
+    # Length of the text the table shows for each value
+    text = series.astype(str).mask(series.isna().to_numpy(), '')
+    return text.str.len().to_numpy(dtype=np.int64)
+
+
+class ColumnText:
+    # The longest display text of one column: its length, the rows that
+    # hold it and its measured width
+    def __init__(self, max_len, holders, width):
+        self.max_len = max_len
+        self.holders = holders
+        self.width = width
+
+
+class ColumnWidths:
+    # Content widths from font metrics on the few longest values of each
+    # column instead of measuring every cell. The longest length per column
+    # is kept up to date from the session's change notifications, so a
+    # column is only measured again when its longest value or the font
+    # changes.
+    def __init__(self, table):
+        self.table = table
+        self.pages = {}
+        self.stale = {}
+
+    def clear(self):
+        self.pages = {}
+        self.stale = {}
+
+    def retain(self, dms):
+        self.pages = {dm: columns for dm, columns in self.pages.items() if dm in dms}
+        self.stale = {dm: stale for dm, stale in self.stale.items() if dm in dms}
+
+    def mark_stale(self, dm, change, *args):
+        # Pages that aren't shown only note which columns changed (None for
+        # all); catch_up() forgets those widths when the page is shown again
+        if dm not in self.pages or self.stale.get(dm, set()) is None:
+            return
+        if change == "cells":
+            self.stale.setdefault(dm, set()).add(args[0])
+        else:
+            self.stale[dm] = None
+
+    def catch_up(self, dm):
+        stale = self.stale.pop(dm, set())
+        if stale is None:
+            self.pages.pop(dm, None)
+            return
+        for col in stale:
+            self.pages[dm].pop(col, None)
+
+    def margin(self):
+        style = self.table.style()
+        return 2 * (style.pixelMetric(QStyle.PM_FocusFrameHMargin, None, self.table) + 1) + 1
+
+    def measure(self, dm, col):
+        series = dm.df[col]
+        if dm.column_types.get(col) == "boolean":
+            return ColumnText(0, set(), self.table.style().pixelMetric(QStyle.PM_IndicatorWidth, None, self.table) + self.margin())
+        lengths = display_lengths(series)
+        if not len(lengths):
+            return ColumnText(0, set(), 0)
+        max_len = int(lengths.max())
+        holders = set(series.index[lengths == max_len])
+        return ColumnText(max_len, holders, self.text_width(series, lengths))
+
+    def text_width(self, series, lengths):
+        longest = np.argsort(lengths, kind='stable')[-SAMPLE:]
+        self.table.ensurePolished()
+        metrics = self.table.fontMetrics()
+        width = max(metrics.horizontalAdvance(str(series.iat[pos]) if lengths[pos] else '') for pos in longest)
+        return width + self.margin()
+
+    def content_width(self, dm, col):
+        columns = self.pages.setdefault(dm, {})
+        if col not in columns:
+            columns[col] = self.measure(dm, col)
+        return columns[col].width
+
+    def on_change(self, dm, change, *args):
+        # Returns the columns whose width may have changed, None for all
+        columns = self.pages.get(dm)
+        if columns is None:
+            return set()
+        if change == "cells":
+            col, rows = args
+            if rows is None:
+                columns.pop(col, None)
+                return {col}
+            return {col} if self.update_rows(dm, col, rows) else set()
+        if change == "rows_inserted":
+            positions, = args
+            return {col for col in list(columns) if self.update_rows(dm, col, positions)}
+        if change == "rows_removed":
+            changed = set()
+            remaining = set(dm.df.index)
+            for col, text in list(columns.items()):
+                text.holders &= remaining
+                if not text.holders and text.max_len:
+                    del columns[col]
+                    changed.add(col)
+            return changed
+        if change == "column_removed":
+            for col in [col for col in columns if col not in dm.df.columns]:
+                del columns[col]
+            return set()
+        if change == "column_renamed":
+            old_name, new_name = args
+            if old_name in columns:
+                columns[new_name] = columns.pop(old_name)
+            return {new_name}
+        if change in ("meta", "reset"):
+            del self.pages[dm]
+            return None
+        return set()
+
+    def update_rows(self, dm, col, positions):
+        text = self.pages[dm].get(col)
+        if text is None or col not in dm.df.columns:
+            return False
+        positions = np.asarray(positions, dtype=np.int64)
+        if not len(positions) or dm.column_types.get(col) == "boolean":
+            return False
+        values = dm.df[col].iloc[positions]
+        lengths = display_lengths(values)
+        ids = dm.df.index[positions]
+        longest = int(lengths.max())
+        if longest > text.max_len:
+            # Only the new values can be the longest now
+            text.max_len = longest
+            text.holders = set(ids[lengths == longest])
+            text.width = max(text.width, self.text_width(values, lengths))
+            return True
+        text.holders.difference_update(ids[lengths < text.max_len])
+        text.holders.update(ids[lengths == text.max_len])
+        if not text.holders:
+            del self.pages[dm][col]
+            return True
+        return False
@@ -0,0 +1,116 @@
+# csv_import.py
+import os
+import numpy as np
+import pandas as pd
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+import column_dtypes
+
+# Rows read up front to pick each column's type, and rows converted at a time
+SAMPLE_ROWS = 10000
+CHUNK_ROWS = 100000
+
+
+def sample_types(path, model_col_name="Model"):
+    sample = pd.read_csv(path, nrows=SAMPLE_ROWS)
+    return {col: "string" if col == model_col_name else column_dtypes.infer_type(sample[col]) for col in sample.columns}
+
+
+def as_text(series, typ):
+    # Whole numbers of an integer column read as floats (because of gaps)
+    # keep their integer form
+    if typ == "integer" and pd.api.types.is_float_dtype(series.dtype) and column_dtypes.is_integral(series.to_numpy(dtype=float, na_value=np.nan)):
+        series = series.astype(column_dtypes.DTYPES["integer"])
+    return series.astype(column_dtypes.DTYPES["string"])
+
+
+class ColumnBuffer:
+    # One column's converted chunks. Integers are kept as floats until the
+    # end so a fraction past the sample turns the column float instead of
+    # being cut off; a value that fits neither turns the whole column into
+    # text, so nothing read is dropped.
+    def __init__(self, typ):
+        self.typ = typ
+        self.read_as = typ  # type the values were read as, kept when widened
+        self.chunks = []
+        self.widened = False
+
+    def append(self, text):
+        if self.typ == "string":
+            self.chunks.append(as_text(text, self.read_as).reset_index(drop=True))
+            return
+        values, failed = column_dtypes.coerce(text, "float" if self.typ == "integer" else self.typ)
+        if failed.any():
+            self.widen()
+            self.chunks.append(as_text(text, self.read_as).reset_index(drop=True))
+            return
+        if self.typ == "integer" and not column_dtypes.is_integral(values.to_numpy(dtype=float, na_value=np.nan)):
+            self.typ = "float"
+        self.chunks.append(values.reset_index(drop=True))
+
+    def widen(self):
+        dtype = column_dtypes.DTYPES[self.typ]
+        self.chunks = [as_text(chunk.astype(dtype), self.typ) for chunk in self.chunks]
+        self.read_as = self.typ
+        self.typ = "string"
+        self.widened = True
+
+    def finish(self):
+        if not self.chunks:
+            return pd.Series(pd.array([], dtype=column_dtypes.DTYPES[self.typ]))
+        values = pd.concat(self.chunks, ignore_index=True)
+        self.chunks = []
+        return values.astype(column_dtypes.DTYPES[self.typ])
+
+
+class CsvImport:
+    # Streams a CSV into typed columns: the text of only one chunk is held
+    # at a time. cancel() may be called from any thread.
+    def __init__(self, path):
+        self.path = path
+        self.cancelled = False
+        self.widened = []  # columns read as text because later values didn't fit the sampled type
+
+    def cancel(self):
+        self.cancelled = True
+
+    def read(self, progress=None):
+        # The frame, or None when cancelled; progress gets (bytes read, size)
+        buffers = {col: ColumnBuffer(typ) for col, typ in sample_types(self.path).items()}
+        size = os.path.getsize(self.path)
+        # The parser reads numbers and booleans natively; only a chunk with
+        # stray text in such a column goes through string conversion.
+        # Floats are parsed round-trip, so a column widened to text shows
+        # them as written.
+        text = {col: str for col, buffer in buffers.items() if buffer.typ == "string"}
+        with open(self.path, 'rb') as f:
+            for chunk in pd.read_csv(f, chunksize=CHUNK_ROWS, dtype=text, low_memory=False, float_precision="round_trip"):
+                if self.cancelled:
+                    return None
+                for col, buffer in buffers.items():
+                    buffer.append(chunk[col])
+                if progress is not None:
+                    progress(f.tell(), size)
+        self.widened = [col for col, buffer in buffers.items() if buffer.widened]
+        return pd.DataFrame({col: buffer.finish() for col, buffer in buffers.items()})
+
+
+class CsvImportSignals(QObject):
+    # Emitted from the pool thread; connections run on the GUI thread
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+
+class CsvImportJob(QRunnable):
+    def __init__(self, reader, signals):
+        super().__init__()
+        self.reader = reader
+        self.signals = signals
+
+    def run(self):
+        try:
+            df = self.reader.read(self.signals.progress.emit)
+        except (OSError, ValueError) as e:
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.done.emit(df)
@@ -1,277 +1,487 @@
 # data_model.py
 import copy
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
-import re
 from PyQt5.QtWidgets import QMessageBox
 from PyQt5.QtGui import QColor
-from collections import deque, defaultdict
+import formula_engine
+import column_dtypes
+import tiers
+from dependency_graph import DependencyGraph
+from history import UndoLog, HistoryEntry, CellPatch, ColumnPatch, RowPatch, RenamePatch, FramePatch, MetaPatch, PagePatch, PageRenamePatch
+
+class UpsertReport:
+    # Outcome of merging imported rows into a page by model name
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.failed = {}  # column -> imported values that didn't fit its type
+        self.skipped = []  # computed columns in the import, left alone
+
 
 class DataModel:
-    SESSION_FILE = "leaderboard_session.xlsx"
+    SESSION_FILE = "leaderboard_session.db"
+    LEGACY_SESSION_FILE = "leaderboard_session.xlsx"  # migrated on first start
 
     def __init__(self):
         self.page_name = "Default"
+        self.source = None
+        self.loaded = {}
         self.df = pd.DataFrame(columns=["Model"])
         self.column_types = {}
-        self.df_history = []
         self.model_col_name = "Model"
         self.column_formulas = {}
         self.column_formula_refs = {}
         self.column_tiers = {}
+        self.compiled_tiers = {}
         self.plot_columns = []
         self.all_data_models = None  # Will be set by main
+        self.model_index = None
+        self.model_index_has_dupes = False
+        self.next_row_id = 0
+        self.version = 0
+        self.uid = uuid.uuid4().hex
+        self.data_version = 0  # what the session file compares against; settings changes don't count
         self.set_column_types()
-        self.save_to_history()
+
+    @property
+    def df(self):
+        if self.source is not None:
+            self.load()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self.source = None
+        self.loaded = {}
+        self._df = df
+
+    def load(self):
+        # Pages come out of the session file on first use; until then only
+        # their settings and the columns formulas asked for are in memory
+        if self.source is None:
+            return
+        source = self.source
+        data = source.read([c for c in source.columns if c not in self.loaded])
+        data.update(self.loaded)
+        self.df = pd.DataFrame({c: data[c] for c in source.columns}, index=source.index(), columns=source.columns)
+
+    def columns(self):
+        return pd.Index(self.source.columns) if self.source is not None else self._df.columns
+
+    def column(self, col):
+        # A single column, read without loading the rest of the page
+        if self.source is None:
+            return self._df[col]
+        if col not in self.loaded:
+            self.loaded[col] = self.source.read([col])[col]
+        return self.loaded[col]
+
+    def row_ids(self):
+        return self.source.index() if self.source is not None else self._df.index
+
+    def row_count(self):
+        return self.source.rows if self.source is not None else len(self._df)
+
+    def record(self, patch):
+        if self.all_data_models is not None:
+            self.all_data_models.history.record(patch)
 
     def save_to_history(self):
-        self.df_history.append((copy.deepcopy(self.df), copy.deepcopy(self.column_types), copy.deepcopy(self.column_formulas), copy.deepcopy(self.column_formula_refs), copy.deepcopy(self.column_tiers), copy.deepcopy(self.plot_columns)))
+        if self.all_data_models is not None:
+            self.all_data_models.commit()
 
-    def undo(self):
-        if len(self.df_history) > 1:
-            self.df_history.pop()
-            self.df, self.column_types, self.column_formulas, self.column_formula_refs, self.column_tiers, self.plot_columns = copy.deepcopy(self.df_history[-1])
-            return True
-        return False
+    def batch(self):
+        return self.get_session().batch()
+
+    def log_op(self, op, *args):
+        if self.all_data_models is not None:
+            self.all_data_models.log_op(op, self.page_name, *args)
+
+    def notify(self, change, *args):
+        self.version += 1
+        if change != "meta":
+            self.data_version += 1
+        if self.all_data_models is not None:
+            self.all_data_models.notify(self, change, *args)
+
+    def snapshot(self, deep=True):
+        # Detached copy for writing out or recomputing while editing
+        # continues; a shallow one shares the frame's data copy-on-write
+        dm = DataModel.__new__(DataModel)
+        dm.__dict__.update(self.__dict__)
+        if self.source is None:
+            dm.df = self._df.copy(deep=deep)
+        else:
+            dm.loaded = dict(self.loaded)  # still unloaded, read by whoever needs it
+        dm.column_types, dm.column_formulas, dm.column_formula_refs, dm.column_tiers, dm.plot_columns = self.meta_state()
+        dm.all_data_models = None
+        dm.model_index = None
+        dm.compiled_tiers = {}
+        return dm
+
+    def meta_state(self):
+        return copy.deepcopy((self.column_types, self.column_formulas, self.column_formula_refs, self.column_tiers, self.plot_columns))
+
+    def restore_meta_state(self, state):
+        self.column_types, self.column_formulas, self.column_formula_refs, self.column_tiers, self.plot_columns = copy.deepcopy(state)
+        self.notify("meta")
+
+    def journal_meta(self):
+        return self.column_types, self.column_formulas, self.column_tiers, self.plot_columns
+
+    def restore_journal_meta(self, meta):
+        types, formulas, tiers, plot_columns = meta
+        self.column_types = dict(types)
+        self.column_formulas = dict(formulas)
+        self.column_formula_refs = {c: formula_engine.parse_refs(f) for c, f in formulas.items()}
+        self.column_tiers = {c: (mode, [tuple(t) for t in ts]) for c, (mode, ts) in tiers.items()}
+        self.plot_columns = list(plot_columns)
+
+    def record_meta(self, before):
+        after = self.meta_state()
+        if after != before:
+            self.record(MetaPatch(self, before, after))
+
+    def resync(self):
+        # Rebuild derived state after undo/redo swapped data underneath us
+        self.rebuild_model_index()
+        if self.all_data_models is not None and any(dm is self for dm in self.all_data_models):
+            graph = self.get_dep_graph()
+            graph.remove_page(self.page_name)
+            graph.add_page(self)
+
+    def reindex_rows(self):
+        # Give a freshly loaded or replaced frame its row ids. Ids are the
+        # frame's index labels and never reused within a page, so they stay
+        # valid across edits and deletions; positions are only used inside
+        # vectorized operations.
+        self.df.index = pd.RangeIndex(self.next_row_id, self.next_row_id + len(self.df))
+        self.next_row_id += len(self.df)
+        self.rebuild_model_index()
+
+    def new_row_ids(self, count):
+        ids = pd.RangeIndex(self.next_row_id, self.next_row_id + count)
+        self.next_row_id += count
+        return ids
+
+    def row_positions(self, row_ids):
+        positions = self.df.index.get_indexer(pd.Index(row_ids, dtype=np.int64))
+        if (positions < 0).any():
+            raise ValueError("Row does not exist.")
+        return positions
+
+    def rebuild_model_index(self):
+        # Model name -> row id of its first row, used for uniqueness checks
+        # and cross-page lookups
+        names = self.column(self.model_col_name)
+        present = names.notna().to_numpy()
+        first = present & ~names.duplicated().to_numpy()
+        self.model_index = dict(zip(names[first].tolist(), self.row_ids()[first].tolist()))
+        self.model_index_has_dupes = len(self.model_index) != int(present.sum())
+
+    def has_model(self, model):
+        if self.model_index is None:
+            self.rebuild_model_index()
+        return model in self.model_index
+
+    def lookup_model_rows(self, models):
+        if self.model_index is None:
+            self.rebuild_model_index()
+        # Plain dict lookups: mapping through the index as a Series would
+        # convert the whole dict on every call
+        get = self.model_index.get
+        ids = np.fromiter((get(m, -1) for m in models), np.int64, len(models))
+        positions = self.row_ids().get_indexer(ids)
+        positions[ids < 0] = -1
+        return positions
+
+    def rows_for_models(self, models):
+        if self.model_index is None:
+            self.rebuild_model_index()
+        if self.model_index_has_dupes:
+            return set(np.flatnonzero(self.df[self.model_col_name].isin(list(models)).to_numpy()).tolist())
+        ids = [self.model_index[m] for m in models if m in self.model_index]
+        return set(self.df.index.get_indexer(ids).tolist()) if ids else set()
 
     def set_column_types(self):
+        # Infer each column's type and store it with the matching nullable dtype
         self.column_types = {}
         for col in self.df.columns:
-            if col == "Model":
-                self.column_types[col] = "string"
-            elif pd.api.types.is_bool_dtype(self.df[col]):
-                self.column_types[col] = "boolean"
-            elif pd.api.types.is_numeric_dtype(self.df[col]):
-                all_int = self.df[col].dropna().apply(lambda x: isinstance(x, (int, float)) and float(x).is_integer()).all()
-                self.column_types[col] = "integer" if all_int else "float"
-            else:
-                self.column_types[col] = "string"
+            typ = "string" if col == self.model_col_name else column_dtypes.infer_type(self.df[col])
+            self.column_types[col] = typ
+            if str(self.df[col].dtype) != column_dtypes.DTYPES[typ]:
+                self.df[col] = column_dtypes.typed_series(self.df[col], typ)
 
-    def compute_value(self, row_dict, formula):
-        if not formula:
-            return 0
-        refs = re.findall(r'\{(.*?)\}', formula)
-        values = {}
-        for ref in refs:
-            if ':' in ref:
-                page_name, col_name = ref.split(':', 1)
-                if page_name == self.page_name:
-                    val = row_dict.get(col_name, 0)
-                else:
-                    other_dm = next((dm for dm in self.all_data_models if dm.page_name == page_name), None)
-                    if other_dm:
-                        model = row_dict.get(self.model_col_name, '')
-                        matching = other_dm.df[other_dm.df[self.model_col_name] == model]
-                        if not matching.empty:
-                            val = matching.iloc[0].get(col_name, 0)
-                        else:
-                            val = 0
-                    else:
-                        val = 0
-            else:
-                val = row_dict.get(ref, 0)
-            if isinstance(val, bool):
-                val = 1 if val else 0
-            if not isinstance(val, (int, float)):
-                val = 0
-            values[ref] = val
-        expr = formula
-        for ref in refs:
-            expr = expr.replace(f"{{{ref}}}", str(values[ref]))
-        try:
-            return eval(expr)
-        except:
-            return 0
+    def get_ref_values(self, ref, rows=None):
+        length = len(self.df) if rows is None else len(rows)
+        if ':' in ref:
+            page_name, col_name = ref.split(':', 1)
+        else:
+            page_name, col_name = self.page_name, ref
+        if page_name == self.page_name:
+            if col_name not in self.df.columns:
+                return np.zeros(length)
+            series = self.df[col_name]
+            return formula_engine.numeric_values(series if rows is None else series.iloc[rows])
+        other_dm = next((dm for dm in self.all_data_models or [] if dm.page_name == page_name), None)
+        if other_dm is None or col_name not in other_dm.columns():
+            return np.zeros(length)
+        models = self.df[self.model_col_name]
+        if rows is not None:
+            models = models.iloc[rows]
+        rows = other_dm.lookup_model_rows(models.to_numpy())
+        values = np.zeros(len(rows))
+        found = rows >= 0
+        if found.any():
+            values[found] = formula_engine.numeric_values(other_dm.column(col_name).iloc[rows[found]])
+        return values
+
+    def computed_values(self, col, rows=None):
+        compiled = formula_engine.compile_formula(self.column_formulas[col])
+        inputs = [self.get_ref_values(ref, rows) for ref in compiled.refs]
+        values = compiled.evaluate(inputs, len(self.df) if rows is None else len(rows))
+        return formula_engine.cast_result(values, self.column_types.get(col))
 
-    def recompute_column(self, col):
+    def recompute_column(self, col, rows=None):
         if col not in self.column_formulas:
             return
-        formula = self.column_formulas[col]
-        for i in range(len(self.df)):
-            row_dict = self.df.iloc[i].to_dict()
-            val = self.compute_value(row_dict, formula)
-            self.df.at[i, col] = val
+        values = self.computed_values(col, rows)
+        if rows is None:
+            self.set_column(col, values)
+            return
+        old = self.df[col].array[rows]
+        changed = column_dtypes.changed_mask(old, values)
+        if not changed.any():
+            return
+        rows = np.asarray(rows)[changed]
+        self.set_column_values(col, rows, values[changed])
+        self.record(CellPatch(self, col, rows, old[changed], values[changed]))
+
+    def set_column(self, col, values):
+        old = self.df[col].copy() if col in self.df.columns else None
+        self.df[col] = values
+        if old is None or not old.equals(self.df[col]):
+            self.record(ColumnPatch(self, col, old, self.df[col].copy(), self.df.columns.get_loc(col)))
+            self.notify("cells", col, None)
+
+    def set_column_values(self, col, rows, values):
+        column = self.df[col].array.copy()
+        try:
+            column[rows] = values
+        except (TypeError, ValueError):
+            # Values that don't fit the dtype (e.g. 1.5 in an integer column)
+            # widen it to whatever holds both
+            column = np.asarray(column, dtype=object)
+            column[rows] = np.asarray(values, dtype=object)
+            column = pd.array(column)
+        self.df[col] = column
+        self.notify("cells", col, rows)
+
+    def get_session(self):
+        if self.all_data_models is None:
+            Session([self])
+        return self.all_data_models
+
+    def get_dep_graph(self):
+        return self.get_session().dep_graph
 
     def get_topo_order(self):
-        graph = self.build_dep_graph()
-        rev_graph = defaultdict(list)
-        for u in graph:
-            for v in graph[u]:
-                rev_graph[v].append(u)
-        computed = list(graph.keys())
-        indeg = {node: 0 for node in computed}
-        for u in graph:
-            for v in graph[u]:
-                if v in indeg:
-                    indeg[v] += 1
-        q = deque([node for node in indeg if indeg[node] == 0])
-        order = []
-        while q:
-            u = q.popleft()
-            order.append(u)
-            for v in rev_graph[u]:
-                indeg[v] -= 1
-                if indeg[v] == 0:
-                    q.append(v)
-        if len(order) != len(computed):
-            print("Cycle detected in formula dependencies")
-        return order
+        return self.get_dep_graph().topo_order()
 
     def recompute_all_computed(self):
-        order = self.get_topo_order()
-        for full in order:
+        graph = self.get_dep_graph()
+        for full in graph.topo_order():
             page, col = full.split(':', 1)
             dm = next((d for d in self.all_data_models if d.page_name == page), None)
             if dm:
                 dm.recompute_column(col)
-        graph = self.build_dep_graph()
-        if len(order) < len(graph):
-            all_computed = set(graph.keys())
-            recomputed = set(order)
-            cycle_fulls = all_computed - recomputed
-            for full in cycle_fulls:
+        if graph.cyclic:
+            for full in graph.cyclic:
                 page, col = full.split(':', 1)
                 dm = next((d for d in self.all_data_models if d.page_name == page), None)
                 if dm:
-                    dm.df[col] = 0
+                    dm.set_column(col, formula_engine.cast_result(np.zeros(len(dm.df)), dm.column_types.get(col)))
+
+    def recompute_dependents(self, changed, renamed_models=()):
+        # changed maps "Page:Col" to the row positions edited on that page
+        # (None for the whole column); renamed_models are extra names on
+        # this page whose rows moved or vanished
+        self.get_session().request_recompute(changed, {self.page_name: set(renamed_models)})
 
     def add_model(self, model):
-        if model.strip() == "":
-            raise ValueError("Model name cannot be empty.")
-        if model in self.df[self.model_col_name].tolist():
-            raise ValueError("A model with this name already exists.")
-        new_row = {self.model_col_name: model}
+        self.bulk_add_models([model])
+
+    def bulk_add_models(self, models):
+        models = list(models)
+        if not models:
+            return
+        self.append_models(models)
+        self.save_to_history()
+        self.log_op("bulk_add_models", models)
+
+    def append_models(self, models):
+        # All names are checked first, then the rows go in with one concat;
+        # no commit or journal entry
+        seen = set()
+        for model in models:
+            if model.strip() == "":
+                raise ValueError("Model name cannot be empty.")
+            if model in seen or self.has_model(model):
+                raise ValueError("A model with this name already exists.")
+            seen.add(model)
+        if not models:
+            return
+        data = {self.model_col_name: models}
         for col in self.df.columns:
             if col != self.model_col_name:
-                typ = self.column_types[col]
-                if typ == "string":
-                    new_row[col] = ""
-                elif typ == "integer":
-                    new_row[col] = 0
-                elif typ == "float":
-                    new_row[col] = 0.0
-                elif typ == "boolean":
-                    new_row[col] = False
-        new_df = pd.DataFrame([new_row])
-        self.df = pd.concat([self.df, new_df], ignore_index=True)
-        self.recompute_all_computed()
-        self.save_to_history()
+                data[col] = [column_dtypes.DEFAULTS[self.column_types[col]]] * len(models)
+        ids = self.new_row_ids(len(models))
+        new_df = pd.DataFrame(data, columns=self.df.columns, index=ids).astype(self.df.dtypes.to_dict())
+        dtypes = self.df.dtypes
+        start = len(self.df)
+        self.df = pd.concat([self.df, new_df])
+        for model, row_id in zip(models, ids):
+            self.model_index.setdefault(model, row_id)
+        self.record(RowPatch(self, range(start, len(self.df)), new_df, removed=False, dtypes=dtypes))
+        self.notify("rows_inserted", np.arange(start, len(self.df)))
+        new_rows = set(range(start, len(self.df)))
+        self.recompute_dependents({f"{self.page_name}:{c}": new_rows for c in self.df.columns})
 
     def add_column(self, name, typ):
         if name in self.df.columns:
             raise ValueError("Column name already exists.")
-        if typ == "string":
-            default = ''
-        elif typ == "integer":
-            default = 0
-        elif typ == "float":
-            default = 0.0
-        elif typ == "boolean":
-            default = False
-        self.df[name] = default
-        self.column_types[name] = typ
+        self.insert_column(name, typ)
         self.save_to_history()
+        self.log_op("add_column", name, typ)
+
+    def insert_column(self, name, typ):
+        before = self.meta_state()
+        self.df[name] = column_dtypes.filled(typ, len(self.df), self.df.index)
+        self.column_types[name] = typ
+        self.record(ColumnPatch(self, name, None, self.df[name].copy(), len(self.df.columns) - 1))
+        self.record_meta(before)
+        self.notify("column_inserted", name)
 
     def rename_column(self, old_name, new_name):
         if old_name == self.model_col_name:
             raise ValueError("Cannot rename the Model column.")
         if new_name in self.df.columns:
             raise ValueError("New name already exists.")
+        self.get_session().restructured()
+        pages = self.all_data_models if self.all_data_models is not None else [self]
+        befores = [(dm, dm.meta_state()) for dm in pages]
         self.df = self.df.rename(columns={old_name: new_name})
+        self.record(RenamePatch(self, old_name, new_name))
+        self.notify("column_renamed", old_name, new_name)
         if old_name in self.column_types:
             self.column_types[new_name] = self.column_types.pop(old_name)
         if old_name in self.column_formulas:
             self.column_formulas[new_name] = self.column_formulas.pop(old_name)
             self.column_formula_refs[new_name] = self.column_formula_refs.pop(old_name)
+        self.get_dep_graph().rename_column(self.page_name, old_name, new_name)
         if old_name in self.column_tiers:
             self.column_tiers[new_name] = self.column_tiers.pop(old_name)
         if old_name in self.plot_columns:
             self.plot_columns = [new_name if c == old_name else c for c in self.plot_columns]
+        # Point formulas on every page at the new name
+        for dm in pages:
+            for c, f in list(dm.column_formulas.items()):
+                new_f = f.replace(f"{{{self.page_name}:{old_name}}}", f"{{{self.page_name}:{new_name}}}")
+                if dm is self:
+                    new_f = new_f.replace(f"{{{old_name}}}", f"{{{new_name}}}")
+                if new_f != f:
+                    dm.column_formulas[c] = new_f
+                    dm.column_formula_refs[c] = formula_engine.parse_refs(new_f)
+        for dm, before in befores:
+            dm.record_meta(before)
         self.save_to_history()
+        self.log_op("rename_column", old_name, new_name)
 
-    def change_column_type(self, col, new_typ):
+    def preview_column_type(self, col, new_typ):
+        if col not in self.df.columns:
+            raise ValueError("Column does not exist.")
+        return column_dtypes.convert_column(self.df[col], col, new_typ)
+
+    def change_column_type(self, col, new_typ, report=None):
+        # Values that can't be converted are left missing; the returned
+        # report says which rows those were
         if new_typ == self.column_types.get(col):
-            return
+            return None
+        if report is None or report.col != col or report.new_typ != new_typ or len(report.values) != len(self.df):
+            report = self.preview_column_type(col, new_typ)
+        before = self.meta_state()
+        old = self.df[col].copy()
         self.column_types[col] = new_typ
-        for i in range(len(self.df)):
-            val = self.df.at[i, col]
-            try:
-                if new_typ == "string":
-                    self.df.at[i, col] = str(val)
-                elif new_typ == "integer":
-                    self.df.at[i, col] = int(float(val))
-                elif new_typ == "float":
-                    self.df.at[i, col] = float(val)
-                elif new_typ == "boolean":
-                    self.df.at[i, col] = bool(val)
-            except ValueError:
-                if new_typ == "string":
-                    default = ''
-                elif new_typ == "integer":
-                    default = 0
-                elif new_typ == "float":
-                    default = 0.0
-                elif new_typ == "boolean":
-                    default = False
-                self.df.at[i, col] = default
+        self.df[col] = report.values
+        self.record(ColumnPatch(self, col, old, self.df[col].copy(), self.df.columns.get_loc(col)))
+        self.record_meta(before)
+        self.notify("cells", col, None)
+        self.recompute_dependents({f"{self.page_name}:{col}": None})
         self.save_to_history()
+        self.log_op("change_column_type", col, new_typ)
+        return report
 
-    def remove_rows(self, df_rows):
-        df_rows = sorted(set(df_rows), reverse=True)
-        for df_row in df_rows:
-            self.df.drop(self.df.index[df_row], inplace=True)
-        self.df.reset_index(drop=True, inplace=True)
+    def remove_rows(self, row_ids):
+        mask = self.df.index.isin(list(row_ids))
+        positions = np.flatnonzero(mask)
+        if not len(positions):
+            return
+        self.get_session().restructured()
+        self.drop_rows(mask)
         self.save_to_history()
+        self.log_op("remove_rows", positions.tolist())
 
-    def build_dep_graph(self):
-        graph = {}
-        for dm in self.all_data_models:
-            page = dm.page_name
-            for col in dm.column_formulas:
-                full_target = page + ':' + col
-                graph[full_target] = set()
-                for ref in dm.column_formula_refs[col]:
-                    if ':' not in ref:
-                        ref_full = page + ':' + ref
-                    else:
-                        ref_full = ref
-                    graph[full_target].add(ref_full)
-        return graph
-
-    def has_cycle(self):
-        graph = self.build_dep_graph()
-        visited = {}
-        path = {}
-        def dfs(node):
-            if node in path:
-                return True
-            if node in visited:
-                return False
-            visited[node] = True
-            path[node] = True
-            for neigh in graph.get(node, []):
-                if dfs(neigh):
-                    return True
-            del path[node]
-            return False
-        for node in graph:
-            if node not in visited:
-                if dfs(node):
-                    return True
-        return False
+    def drop_rows(self, mask):
+        # The removal itself, without flagging the batch, committing or
+        # journaling
+        if self.model_index is None:
+            self.rebuild_model_index()
+        positions = np.flatnonzero(mask)
+        removed = self.df[mask].copy()
+        removed_models = set(removed[self.model_col_name].dropna())
+        self.record(RowPatch(self, positions, removed, removed=True))
+        self.df = self.df[~mask]
+        self.notify("rows_removed", positions)
+        if self.model_index_has_dupes:
+            self.rebuild_model_index()
+        else:
+            for model, row_id in zip(removed[self.model_col_name], removed.index):
+                if self.model_index.get(model) == row_id:
+                    del self.model_index[model]
+        self.recompute_dependents({f"{self.page_name}:{c}": set() for c in self.df.columns}, removed_models)
 
     def set_column_formula(self, col, formula):
         if col not in self.df.columns:
             raise ValueError("Column does not exist.")
         if self.column_types.get(col) not in ["integer", "float", "boolean"]:
             raise ValueError("Column must be numeric.")
-        refs = set(re.findall(r'\{(.*?)\}', formula))
+        graph = self.get_dep_graph()
+        before = self.meta_state()
+        if not formula.strip():
+            # An empty formula turns the column back into plain data
+            if col in self.column_formulas:
+                del self.column_formulas[col]
+                del self.column_formula_refs[col]
+                graph.remove_formula(self.page_name, col)
+                self.record_meta(before)
+                self.recompute_dependents({f"{self.page_name}:{col}": None})
+                self.save_to_history()
+                self.log_op("set_column_formula", col, formula)
+            return
+        refs = formula_engine.parse_refs(formula)
         for ref in refs:
             if ':' in ref:
                 page, c = ref.split(':', 1)
                 other_dm = next((dm for dm in self.all_data_models if dm.page_name == page), None)
                 if not other_dm:
                     raise ValueError(f"Page {page} not found.")
-                if c not in other_dm.df.columns:
+                if c not in other_dm.columns():
                     raise ValueError(f"Column {c} not found in page {page}.")
                 if other_dm.column_types.get(c) not in ["integer", "float", "boolean"]:
                     raise ValueError(f"Column {c} in page {page} is not numeric.")
@@ -282,63 +492,116 @@ class DataModel:
                     raise ValueError(f"Column {ref} is not numeric.")
             if ref == col:
                 raise ValueError("Formula cannot reference itself.")
-        old_formula = self.column_formulas.get(col)
-        old_refs = self.column_formula_refs.get(col)
+        if graph.creates_cycle(self.page_name, col, refs):
+            raise ValueError("Formula creates a dependency cycle.")
         self.column_formulas[col] = formula
         self.column_formula_refs[col] = refs
-        if self.has_cycle():
-            if old_formula is not None:
-                self.column_formulas[col] = old_formula
-                self.column_formula_refs[col] = old_refs
-            else:
-                del self.column_formulas[col]
-                del self.column_formula_refs[col]
-            raise ValueError("Formula creates a dependency cycle.")
-        self.recompute_all_computed()
+        graph.set_formula(self.page_name, col, refs)
+        self.record_meta(before)
+        self.recompute_dependents({f"{self.page_name}:{col}": None})
         self.save_to_history()
+        self.log_op("set_column_formula", col, formula)
 
-    def update_cell(self, df_row, header, val):
+    def parse_value(self, header, val):
         typ = self.column_types.get(header, "string")
-        old_val = self.df.at[df_row, header]
-        if header == self.model_col_name:
-            if val.strip() == "":
-                raise ValueError("Model name cannot be empty.")
-            if val in self.df[self.model_col_name].tolist() and val != old_val:
-                raise ValueError("A model with this name already exists.")
         try:
             if typ == "string":
-                parsed_val = str(val)
+                return str(val)
             elif typ == "integer":
-                parsed_val = int(val)
+                value = int(val)
+                if not -2 ** 63 <= value < 2 ** 63:
+                    raise ValueError  # doesn't fit the Int64 column
+                return value
             elif typ == "float":
-                parsed_val = float(val)
+                return float(val)
             elif typ == "boolean":
-                parsed_val = bool(val)
-        except ValueError:
+                return bool(val)
+        except (ValueError, OverflowError):
             raise ValueError(f"Invalid input '{val}' for {typ} type.")
-        if parsed_val == old_val:
+
+    def update_cell(self, row_id, header, val):
+        if self.model_index is None:
+            self.rebuild_model_index()
+        old_val = self.df.at[row_id, header]
+        if header == self.model_col_name:
+            if val.strip() == "":
+                raise ValueError("Model name cannot be empty.")
+            if val != old_val and self.has_model(val):
+                raise ValueError("A model with this name already exists.")
+        parsed_val = self.parse_value(header, val)
+        if pd.notna(old_val) and parsed_val == old_val:
             return
-        self.df.at[df_row, header] = parsed_val
-        self.recompute_all_computed()
+        pos = self.df.index.get_loc(row_id)
+        self.df.at[row_id, header] = parsed_val
+        self.record(CellPatch(self, header, [pos], [old_val], [parsed_val]))
+        self.notify("cells", header, [pos])
+        if header == self.model_col_name:
+            if self.model_index_has_dupes:
+                self.rebuild_model_index()
+            else:
+                self.model_index.pop(old_val, None)
+                self.model_index[parsed_val] = row_id
+            # The row now joins other pages under a different name
+            self.recompute_dependents({f"{self.page_name}:{c}": {pos} for c in self.df.columns}, {old_val})
+        else:
+            self.recompute_dependents({f"{self.page_name}:{header}": {pos}})
         self.save_to_history()
+        self.log_op("update_cell", pos, header, val)
+
+    def bulk_update(self, updates):
+        # updates are (row_id, header, val) like update_cell. Every value is
+        # parsed before anything changes; each data column is then written
+        # in one go. Model names go through update_cell for their checks.
+        updates = list(updates)
+        by_col = {}
+        for row_id, header, val in updates:
+            if header not in self.df.columns:
+                raise ValueError(f"Column {header} does not exist.")
+            by_col.setdefault(header, {})[row_id] = val
+        parsed = {}
+        for header, cells in by_col.items():
+            if header != self.model_col_name:
+                parsed[header] = (self.row_positions(list(cells)), [self.parse_value(header, v) for v in cells.values()])
+        with self.batch():
+            for header, (rows, values) in parsed.items():
+                values = pd.array(values, dtype=self.df[header].dtype) if len(values) else values
+                old = self.df[header].array[rows]
+                changed = column_dtypes.changed_mask(old, values)
+                if not changed.any():
+                    continue
+                rows, old, values = rows[changed], old[changed], values[changed]
+                self.set_column_values(header, rows, values)
+                self.record(CellPatch(self, header, rows, old, values))
+                self.recompute_dependents({f"{self.page_name}:{header}": set(rows.tolist())})
+            if parsed:
+                data_updates = [(r, h, v) for r, h, v in updates if h != self.model_col_name]
+                positions = self.row_positions([r for r, _, _ in data_updates])
+                self.log_op("bulk_update", [(int(p), h, v) for p, (_, h, v) in zip(positions, data_updates)])
+            for row_id, val in by_col.get(self.model_col_name, {}).items():
+                self.update_cell(row_id, self.model_col_name, val)
 
     def delete_column(self, col):
         if col == self.model_col_name:
             raise ValueError("Cannot delete the Model column.")
         if col in self.column_formulas:
             raise ValueError("Cannot delete a computed column. Remove formula first.")
-        ref = f"{self.page_name}:{col}"
-        for dm in self.all_data_models:
-            for refs in dm.column_formula_refs.values():
-                if any(r == col and dm == self or r == ref for r in refs):
-                    raise ValueError(f"Column is used in a formula in page {dm.page_name}")
+        dependents = self.get_dep_graph().dependents.get(f"{self.page_name}:{col}")
+        if dependents:
+            page = sorted(dependents)[0].split(':', 1)[0]
+            raise ValueError(f"Column is used in a formula in page {page}")
+        before = self.meta_state()
+        position = self.df.columns.get_loc(col)
+        self.record(ColumnPatch(self, col, self.df[col].copy(), None, position))
         if col in self.column_tiers:
             del self.column_tiers[col]
         self.df.drop(columns=[col], inplace=True)
+        self.notify("column_removed", position)
         if col in self.column_types:
             del self.column_types[col]
         self.plot_columns = [c for c in self.plot_columns if c != col]
+        self.record_meta(before)
         self.save_to_history()
+        self.log_op("delete_column", col)
 
     def set_column_tiers(self, col, tier_mode, tiers):
         if col not in self.df.columns:
@@ -348,29 +611,407 @@ class DataModel:
             raise ValueError("String mode invalid for numeric column.")
         if typ == "string" and tier_mode not in ["string"]:
             raise ValueError("Only string mode for string column.")
+        before = self.meta_state()
         self.column_tiers[col] = (tier_mode, tiers)
+        self.record_meta(before)
+        self.notify("meta")
+        self.save_to_history()
+        self.log_op("set_column_tiers", col, tier_mode, tiers)
+
+    def set_plot_columns(self, cols):
+        before = self.meta_state()
+        self.plot_columns = list(cols)
+        self.record_meta(before)
         self.save_to_history()
+        self.log_op("set_plot_columns", self.plot_columns)
+
+    def replace_data(self, df):
+        self.get_session().restructured()
+        before = self.meta_state()
+        old_df = self.df
+        self.df = df
+        self.set_column_types()
+        self.reindex_rows()
+        self.record(FramePatch(self, old_df, df))
+        self.record_meta(before)
+        self.notify("reset")
+        self.log_op("replace_data", df)
+
+    def upsert_data(self, df, remove_missing=False):
+        # Merges imported rows by model name, a hash join on the model
+        # index: matching rows take the imported values, new models are
+        # appended and, with remove_missing, rows of models not in the
+        # import go. Blank imported cells keep what is there. Only the
+        # cells that changed are recomputed downstream.
+        if self.model_col_name not in df.columns:
+            raise ValueError(f"Imported data has no {self.model_col_name} column.")
+        names = df[self.model_col_name].astype(column_dtypes.DTYPES["string"]).str.strip()
+        keep = (names.notna() & (names != '')).to_numpy(dtype=bool)
+        keep &= ~names.duplicated(keep='last').to_numpy()  # a model listed twice takes its last row
+        df, names = df[keep], names[keep]
+        report = UpsertReport()
+        if self.model_index is None:
+            self.rebuild_model_index()
+        matched = names.map(self.model_index).notna().to_numpy()
+        columns = []
+        for col in df.columns:
+            if col == self.model_col_name:
+                continue
+            if col in self.column_formulas:
+                report.skipped.append(col)
+            else:
+                columns.append(col)
+        with self.batch() as session:
+            if remove_missing:
+                missing = ~self.df[self.model_col_name].isin(set(names)).to_numpy()
+                if missing.any():
+                    if session.batch_changed:
+                        session.restructured()  # joined a batch whose row positions this moves
+                    self.drop_rows(missing)
+                    report.removed = int(missing.sum())
+            for col in columns:
+                if col not in self.df.columns:
+                    self.insert_column(col, column_dtypes.infer_type(df[col]))
+            self.append_models(names[~matched].tolist())
+            positions = self.row_positions(names.map(self.model_index).to_numpy(dtype=np.int64))
+            updated = np.zeros(len(df), dtype=bool)
+            for col in columns:
+                typ = self.column_types[col]
+                values, failed = column_dtypes.coerce(df[col], "float" if typ == "integer" else typ)
+                if typ == "integer":
+                    numbers = values.to_numpy(dtype=float, na_value=np.nan)
+                    failed |= ~np.isnan(numbers) & (numbers != np.trunc(numbers))
+                    values = pd.Series(pd.array(np.where(failed, np.nan, numbers), dtype=column_dtypes.DTYPES["float"])).astype(column_dtypes.DTYPES[typ])
+                if failed.any():
+                    report.failed[col] = int(failed.sum())
+                values = pd.array(values.to_numpy(dtype=object), dtype=self.df[col].dtype)
+                old = self.df[col].array[positions]
+                changed = column_dtypes.changed_mask(old, values) & ~pd.isna(values)
+                if not changed.any():
+                    continue
+                updated |= changed
+                rows = positions[changed]
+                self.set_column_values(col, rows, values[changed])
+                self.record(CellPatch(self, col, rows, old[changed], values[changed]))
+                self.recompute_dependents({f"{self.page_name}:{col}": set(rows.tolist())})
+            report.inserted = int((~matched).sum())
+            report.updated = int((updated & matched).sum())
+            report.unchanged = int(matched.sum()) - report.updated
+            self.log_op("upsert_data", df, remove_missing)
+        return report
+
+    def tier_classifier(self, col):
+        # Compiled on first use; every change to a column's tiers (including
+        # undo and load) installs a new config object, which invalidates it
+        config = self.column_tiers.get(col)
+        if config is None:
+            return None
+        compiled = self.compiled_tiers.get(col)
+        if compiled is None or compiled.config is not config:
+            compiled = tiers.CompiledTiers(config)
+            self.compiled_tiers[col] = compiled
+        return compiled
+
+    def tier_styles(self, col, values=None):
+        values = self.df[col] if values is None else values
+        compiled = self.tier_classifier(col)
+        if compiled is None:
+            return [tiers.NO_TIER] * len(values)
+        return compiled.styles_for(values)
+
+    def tier_style(self, col, value):
+        return self.tier_styles(col, pd.Series([value], dtype=object))[0]
 
     def get_column_color(self, col, value):
-        if col not in self.column_tiers:
-            return QColor("transparent")
-        tier_mode, tiers = self.column_tiers[col]
+        return QColor(self.tier_style(col, value).color)
+
+
+class Session(list):
+    # The pages of one workbook plus the state they share
+    def __init__(self, dms=(), history_bytes=UndoLog.MAX_BYTES, history_entries=UndoLog.MAX_ENTRIES):
+        super().__init__(dms)
+        self.dep_graph = DependencyGraph()
+        self.history = UndoLog(history_bytes, history_entries)
+        self.journal = None
+        self.journal_seq = 0  # last journal entry contained in the loaded file
+        self.needs_recompute = False  # computed columns as loaded may lag behind their inputs
+        self.batch_depth = 0
+        self.batch_changed = {}
+        self.batch_renamed = defaultdict(set)
+        self.batch_full = False
+        self.batch_ops = []
+        self.listeners = []  # called with (dm, change, *args) after data changes
+        self.runner = None  # RecomputeRunner when large recomputes go to a worker thread
+        self.deferred = set()  # changed nodes left to the runner by the op in progress
+        for dm in self:
+            dm.all_data_models = self
+        self.dep_graph.rebuild(self)
+
+    def append(self, dm):
+        super().append(dm)
+        dm.all_data_models = self
+        self.dep_graph.add_page(dm)
+
+    def __delitem__(self, index):
+        removed = self[index] if isinstance(index, slice) else [self[index]]
+        super().__delitem__(index)
+        for dm in removed:
+            self.dep_graph.remove_page(dm.page_name)
+
+    def insert(self, index, dm):
+        super().insert(index, dm)
+        dm.all_data_models = self
+        self.dep_graph.add_page(dm)
+
+    def page(self, name):
+        return next((d for d in self if d.page_name == name), None)
+
+    def commit(self):
+        if not self.batch_depth:
+            self.commit_entry()
+
+    def commit_entry(self):
+        # An entry whose recompute was deferred, or made while one is still
+        # running, gets the results folded in when they land
+        entry = self.history.commit(self.journal_position())
+        if self.runner is None or not (self.deferred or self.runner.busy() and entry is not None):
+            return
+        merged = self.runner.busy()
+        if entry is not None:
+            entry.recompute = self.deferred
+            entry.merged = merged
+        nodes = self.deferred
+        self.deferred = set()
+        self.runner.start(None if merged or entry is None else nodes)
+
+    def journal_position(self):
+        return self.journal.seq if self.journal is not None else None
+
+    @contextmanager
+    def batch(self):
+        # Mutations inside share one recompute, one undo entry and one
+        # journal flush at the end; an exception reverts all of them.
+        # Nested batches join the outermost one.
+        if self.batch_depth:
+            self.batch_depth += 1
+            try:
+                yield self
+            finally:
+                self.batch_depth -= 1
+            return
+        self.commit_entry()
+        self.batch_depth = 1
+        self.batch_changed = {}
+        self.batch_renamed = defaultdict(set)
+        self.batch_full = False
+        self.batch_ops = []
         try:
-            if tier_mode == "string":
-                value_str = str(value)
-                for pattern, _, color in tiers:
-                    if value_str == pattern:
-                        return QColor(color)
-            elif tier_mode == "min_threshold":
-                value = float(value)
-                for min_val, _, color in tiers:
-                    if value >= min_val:
-                        return QColor(color)
-            elif tier_mode == "range":
-                value = float(value)
-                for min_val, max_val, _, color in tiers:
-                    if min_val <= value <= max_val:
-                        return QColor(color)
-            return QColor("transparent")
-        except ValueError:
-            return QColor("transparent")
\ No newline at end of file
+            yield self
+            self.batch_depth = 0
+            if self.batch_full:
+                self.recompute_all()
+            elif self.batch_changed:
+                self.request_recompute(self.batch_changed, self.batch_renamed)
+        except BaseException:
+            self.batch_depth = 0
+            HistoryEntry(self.history.pending).revert()
+            self.history.pending = []
+            self.batch_ops = []
+            self.deferred = set()
+            raise
+        self.commit_entry()
+        for op in self.batch_ops:
+            self.log_op(*op)
+        self.batch_ops = []
+
+    def restructured(self):
+        # Rows or names moved, so row positions and node names collected so
+        # far in a batch can't be trusted: recompute everything at the end
+        if self.batch_depth:
+            self.batch_full = True
+
+    def request_recompute(self, changed, renamed):
+        if not self.batch_depth:
+            if self.runner is not None and self.runner.should_defer(changed):
+                self.deferred |= set(changed)
+            else:
+                self.recompute(changed, renamed)
+            return
+        for node, rows in changed.items():
+            pending = self.batch_changed.get(node, set())
+            self.batch_changed[node] = None if rows is None or pending is None else pending | rows
+        for page, models in renamed.items():
+            self.batch_renamed[page] |= models
+
+    def recompute(self, changed, renamed):
+        # Only computed columns downstream of the changed inputs are
+        # recomputed, and only on the rows that can differ: the same rows on
+        # the same page, rows with matching model names on other pages.
+        # renamed maps a page to model names whose rows moved or vanished,
+        # so other pages joining on them update too.
+        graph = self.dep_graph
+        affected = graph.downstream(changed)
+        dirty = dict(changed)
+        for full in graph.topo_order():
+            if full not in affected:
+                continue
+            page, col = full.split(':', 1)
+            dm = self.page(page)
+            if dm is None:
+                continue
+            rows = dirty.get(full, set())
+            for ref in graph.refs[full]:
+                if rows is None:
+                    break
+                if ref not in dirty:
+                    continue
+                ref_page = ref.split(':', 1)[0]
+                ref_rows = dirty[ref]
+                if ref_rows is None:
+                    rows = None
+                elif ref_page == page:
+                    rows = rows | ref_rows
+                else:
+                    src = self.page(ref_page)
+                    models = set(src.df[src.model_col_name].iloc[sorted(ref_rows)]) if src is not None else set()
+                    models |= renamed.get(ref_page, set())
+                    rows = rows | dm.rows_for_models(models)
+            if rows is None or rows:
+                dm.recompute_column(col, None if rows is None else sorted(rows))
+                dirty[full] = rows
+
+    def recompute_all(self):
+        nodes = dict.fromkeys(self.dep_graph.refs)
+        if self.runner is not None and self.runner.should_defer(nodes):
+            self.deferred |= set(nodes)
+        elif self:
+            self[0].recompute_all_computed()
+
+    def recompute_plan(self, nodes):
+        # Computed columns to refresh, in dependency order, when the given
+        # nodes changed (None for every one); columns stuck in a cycle
+        # become zeros like in recompute_all_computed
+        graph = self.dep_graph
+        affected = set(graph.refs) if nodes is None else graph.downstream(nodes)
+        order = [full for full in graph.topo_order() if full in affected]
+        return order + sorted(affected & graph.cyclic)
+
+    def land_recompute(self, results):
+        # Results of a background recompute, all applied in one go; the
+        # patches join the newest undo entry
+        for full, values in results.items():
+            page, col = full.split(':', 1)
+            dm = self.page(page)
+            if dm is not None and col in dm.df.columns and len(values) == len(dm.df):
+                dm.set_column(col, values)
+        self.history.amend()
+        if self.history.undo_stack:
+            self.history.undo_stack[-1].recompute = None
+
+    def add_page(self, dm):
+        self.append(dm)
+        self.history.record(PagePatch(self, dm, len(self) - 1, removed=False))
+        dm.recompute_dependents({f"{dm.page_name}:{c}": None for c in dm.df.columns})
+        self.commit()
+        self.log_op("add_page", dm.page_name, dm.df, dm.column_types)
+
+    def remove_page(self, index):
+        dm = self[index]
+        dm.load()  # undo may bring it back after the session file has moved on
+        self.restructured()
+        del self[index]
+        self.history.record(PagePatch(self, dm, index, removed=True))
+        dm.recompute_dependents({f"{dm.page_name}:{c}": None for c in dm.columns()})
+        self.commit()
+        self.log_op("remove_page", dm.page_name)
+
+    def rename_page(self, dm, new_name):
+        old_name = dm.page_name
+        self.restructured()
+        befores = [(d, d.meta_state()) for d in self]
+        for d in self:
+            for c, f in list(d.column_formulas.items()):
+                new_f = f.replace(f"{{{old_name}:", f"{{{new_name}:")
+                if new_f != f:
+                    d.column_formulas[c] = new_f
+                    d.column_formula_refs[c] = formula_engine.parse_refs(new_f)
+        self.set_page_name(dm, new_name)
+        self.history.record(PageRenamePatch(self, dm, old_name, new_name))
+        for d, before in befores:
+            d.record_meta(before)
+        dm.recompute_dependents({f"{new_name}:{c}": None for c in dm.columns()})
+        self.commit()
+        self.log_op("rename_page", old_name, new_name)
+
+    def set_page_name(self, dm, name):
+        dm.load()  # a lazy page is found in the session file by its name
+        self.dep_graph.rename_page(dm.page_name, name)
+        dm.page_name = name
+
+    def notify(self, dm, change, *args):
+        for listener in self.listeners:
+            listener(dm, change, *args)
+
+    def log_op(self, op, page, *args):
+        if self.batch_depth:
+            self.batch_ops.append((op, page) + args)
+        elif self.journal is not None:
+            self.journal.append(self, op, page, *args)
+
+    def undo(self):
+        if self.batch_depth:
+            return None
+        names = {id(d): d.page_name for d in self}
+        pages = self.history.undo()
+        if pages is not None:
+            entry = self.history.redo_stack[-1]
+            if self.runner is not None and (entry.merged or self.runner.busy()):
+                # Its revert brings back values computed for a state that
+                # was itself waiting on a recompute
+                self.runner.start(None)
+            self.log_history_step("undo", entry, names)
+        return pages
+
+    def redo(self):
+        if self.batch_depth:
+            return None
+        names = {id(d): d.page_name for d in self}
+        pages = self.history.redo()
+        if pages is not None:
+            entry = self.history.undo_stack[-1]
+            if self.runner is not None and (entry.merged or self.runner.busy()):
+                self.runner.start(None)
+            elif self.runner is not None and entry.recompute is not None:
+                self.runner.start(entry.recompute)
+            self.log_history_step("redo", entry, names)
+        return pages
+
+    def log_history_step(self, op, entry, names):
+        if self.journal is None:
+            return
+        if self.journal.covers(entry.seq):
+            self.log_op(op, None)
+            return
+        # Replay won't have this entry in its history (it predates the
+        # session file), so journal the pages it left behind instead
+        pages = [(names.get(id(dm)), dm.page_name, dm.df, dm.journal_meta()) for dm in entry.pages() if any(dm is d for d in self)]
+        self.log_op("restore_pages", None, [d.page_name for d in self], pages)
+
+    def restore_pages(self, order, pages):
+        # Replays an undo/redo by its effect: each listed page (found by its
+        # old name, or new) takes the given data and settings, then the
+        # session keeps exactly the pages in order
+        by_name = {d.page_name: d for d in self}
+        for old_name, name, df, meta in pages:
+            dm = by_name.pop(old_name, None) if old_name is not None else None
+            if dm is None:
+                dm = DataModel()
+            dm.page_name = name
+            dm.df = df
+            dm.restore_journal_meta(meta)
+            dm.reindex_rows()
+            by_name[name] = dm
+            dm.notify("reset")
+        del self[:]
+        for name in order:
+            self.append(by_name[name])
@@ -0,0 +1,119 @@
+# dependency_graph.py
+from collections import deque, defaultdict
+
+
+def qualify(page, ref):
+    return ref if ':' in ref else page + ':' + ref
+
+
+class DependencyGraph:
+    def __init__(self):
+        self.refs = {}  # "Page:Col" of a computed column -> nodes its formula reads
+        self.dependents = defaultdict(set)  # node -> computed columns reading it
+        self.order = None
+        self.cyclic = set()
+
+    def rebuild(self, dms):
+        self.refs = {}
+        self.dependents = defaultdict(set)
+        for dm in dms:
+            self.add_page(dm)
+
+    def add_page(self, dm):
+        for col, refs in dm.column_formula_refs.items():
+            self.set_formula(dm.page_name, col, refs)
+        self.order = None
+
+    def remove_page(self, page_name):
+        prefix = page_name + ':'
+        for node in [n for n in self.refs if n.startswith(prefix)]:
+            self._remove(node)
+        self.order = None
+
+    def set_formula(self, page_name, col, refs):
+        node = page_name + ':' + col
+        self._remove(node)
+        self.refs[node] = {qualify(page_name, r) for r in refs}
+        for ref in self.refs[node]:
+            self.dependents[ref].add(node)
+        self.order = None
+
+    def remove_formula(self, page_name, col):
+        self._remove(page_name + ':' + col)
+        self.order = None
+
+    def _remove(self, node):
+        for ref in self.refs.pop(node, ()):
+            self.dependents[ref].discard(node)
+            if not self.dependents[ref]:
+                del self.dependents[ref]
+
+    def rename_column(self, page_name, old_name, new_name):
+        self._rename(page_name + ':' + old_name, page_name + ':' + new_name)
+        self.order = None
+
+    def rename_page(self, old_name, new_name):
+        prefix = old_name + ':'
+        nodes = set(self.refs) | set(self.dependents)
+        for node in [n for n in nodes if n.startswith(prefix)]:
+            self._rename(node, new_name + ':' + node[len(prefix):])
+        self.order = None
+
+    def _rename(self, old, new):
+        if old in self.refs:
+            refs = self.refs.pop(old)
+            self.refs[new] = refs
+            for ref in refs:
+                self.dependents[ref].discard(old)
+                self.dependents[ref].add(new)
+        if old in self.dependents:
+            deps = self.dependents.pop(old)
+            self.dependents[new] = deps
+            for dep in deps:
+                self.refs[dep].discard(old)
+                self.refs[dep].add(new)
+
+    def creates_cycle(self, page_name, col, refs):
+        # Only the new edges can close a cycle: walk from them and see
+        # whether the target column is reachable
+        node = page_name + ':' + col
+        stack = [qualify(page_name, r) for r in refs]
+        seen = set()
+        while stack:
+            current = stack.pop()
+            if current == node:
+                return True
+            if current in seen:
+                continue
+            seen.add(current)
+            stack.extend(self.refs.get(current, ()))
+        return False
+
+    def topo_order(self):
+        if self.order is not None:
+            return self.order
+        indeg = {node: sum(1 for r in refs if r in self.refs) for node, refs in self.refs.items()}
+        q = deque([node for node in indeg if indeg[node] == 0])
+        order = []
+        while q:
+            u = q.popleft()
+            order.append(u)
+            for v in self.dependents.get(u, ()):
+                indeg[v] -= 1
+                if indeg[v] == 0:
+                    q.append(v)
+        self.cyclic = set(self.refs) - set(order)
+        if self.cyclic:
+            print("Cycle detected in formula dependencies")
+        self.order = order
+        return order
+
+    def downstream(self, nodes):
+        affected = set(nodes)
+        stack = list(nodes)
+        while stack:
+            for node in self.dependents.get(stack.pop(), ()):
+                if node not in affected:
+                    affected.add(node)
+                    stack.append(node)
+        return affected
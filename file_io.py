@@ -1,22 +1,24 @@
 # file_io.py
 import os
 import pandas as pd
-import re
+import formula_engine
+import column_dtypes
 import data_model
 
 def load_multi(session_file):
     if not os.path.exists(session_file):
         dm = data_model.DataModel()
-        return [dm]
+        return data_model.Session([dm])
     xls = pd.ExcelFile(session_file)
     if 'Metadata' not in xls.sheet_names:
         # Treat as single sheet
         df = pd.read_excel(session_file)
         dm = data_model.DataModel()
-        dm.df = df.fillna('')
+        dm.df = df
         dm.set_column_types()
+        dm.reindex_rows()
         dm.page_name = "Default"
-        return [dm]
+        return data_model.Session([dm])
     metadata = pd.read_excel(xls, 'Metadata')
     dms = []
     for _, row in metadata.iterrows():
@@ -24,8 +26,9 @@ def load_multi(session_file):
         df = pd.read_excel(xls, page_name)
         dm = data_model.DataModel()
         dm.page_name = page_name
-        dm.df = df.fillna('')
+        dm.df = df
         dm.set_column_types()
+        dm.reindex_rows()
         # Load formulas
         if 'formulas_str' in row and pd.notna(row['formulas_str']):
             strs = row['formulas_str'].split('|')
@@ -35,7 +38,7 @@ def load_multi(session_file):
                 if ':' in s:
                     c, f = s.split(':', 1)
                     dm.column_formulas[c] = f.replace('||', '|')
-                    dm.column_formula_refs[c] = set(re.findall(r'\{(.*?)\}', dm.column_formulas[c]))
+                    dm.column_formula_refs[c] = formula_engine.parse_refs(dm.column_formulas[c])
         # Load tiers
         if 'tiers_str' in row and pd.notna(row['tiers_str']):
             strs = row['tiers_str'].split('|')
@@ -87,7 +90,7 @@ def load_multi(session_file):
             formula = row['formula'] if pd.notna(row['formula']) else ""
             if formula:
                 dm.column_formulas[score_col] = formula
-                dm.column_formula_refs[score_col] = set(re.findall(r'\{(.*?)\}', formula))
+                dm.column_formula_refs[score_col] = formula_engine.parse_refs(formula)
             if 'score_tiers_str' in row and pd.notna(row['score_tiers_str']):
                 strs = row['score_tiers_str'].split('|')
                 tiers = []
@@ -118,10 +121,21 @@ def load_multi(session_file):
                     tiers.append((minv, maxv, label, color))
                 dm.column_tiers[penalty_col] = ("range", sorted(tiers, key=lambda x: x[0]))
         dm.plot_columns = row['plot_columns'].split(',') if 'plot_columns' in row and pd.notna(row['plot_columns']) else []
+        # Saved types win over inference, which can't tell e.g. an empty
+        # integer column from a string one
+        if 'types_str' in row and pd.notna(row['types_str']):
+            for s in row['types_str'].split('|'):
+                c, typ = s.rsplit(':', 1)
+                if c in dm.df.columns and typ in column_dtypes.DTYPES and str(dm.df[c].dtype) != column_dtypes.DTYPES[typ]:
+                    dm.column_types[c] = typ
+                    dm.df[c] = column_dtypes.typed_series(dm.df[c], typ)
         dms.append(dm)
-    return dms
+    session = data_model.Session(dms)
+    if 'journal_seq' in metadata.columns and pd.notna(metadata['journal_seq'].iloc[0]):
+        session.journal_seq = int(metadata['journal_seq'].iloc[0])
+    return session
 
-def save_multi(dms, session_file):
+def save_multi(dms, session_file, journal_seq=None):
     with pd.ExcelWriter(session_file) as writer:
         metadata = []
         for dm in dms:
@@ -152,6 +166,9 @@ def save_multi(dms, session_file):
             tiers_str = '|'.join(tiers_str_list)
             meta['tiers_str'] = tiers_str if tiers_str else None
             meta['plot_columns'] = ','.join(dm.plot_columns) if dm.plot_columns else None
+            meta['types_str'] = '|'.join(f"{c}:{t}" for c, t in dm.column_types.items()) or None
+            if journal_seq is not None:
+                meta['journal_seq'] = journal_seq
             metadata.append(meta)
         pd.DataFrame(metadata).to_excel(writer, sheet_name='Metadata', index=False)
         for dm in dms:
@@ -0,0 +1,170 @@
+# formula_engine.py
+import ast
+import re
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from column_dtypes import DTYPES
+
+REF_PATTERN = re.compile(r'\{(.*?)\}')
+
+BIN_OPS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.FloorDiv: np.floor_divide,
+    ast.Mod: np.mod,
+    ast.Pow: np.power,
+}
+
+COMPARE_OPS = {
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+}
+
+FUNCTIONS = {
+    'abs': lambda *a: np.abs(a[0]),
+    'min': lambda *a: np.minimum.reduce(np.broadcast_arrays(*a)) if len(a) > 1 else a[0],
+    'max': lambda *a: np.maximum.reduce(np.broadcast_arrays(*a)) if len(a) > 1 else a[0],
+    'round': lambda *a: np.round(a[0]) if len(a) == 1 else np.round(a[0], int(a[1])),
+    'pow': lambda *a: np.power(a[0], a[1]),
+    'int': lambda *a: np.trunc(a[0]),
+    'float': lambda *a: a[0],
+    'bool': lambda *a: (a[0] != 0).astype(float),
+}
+
+
+class FormulaError(Exception):
+    pass
+
+
+class CompiledFormula:
+    def __init__(self, formula):
+        self.formula = formula
+        self.refs = []
+        names = {}
+
+        def placeholder(match):
+            ref = match.group(1)
+            if ref not in names:
+                names[ref] = f"_ref{len(self.refs)}"
+                self.refs.append(ref)
+            return names[ref]
+
+        expr = REF_PATTERN.sub(placeholder, formula).strip()
+        self.slots = {name: i for i, name in enumerate(names.values())}
+        self.error = None
+        try:
+            self.root = self._build(ast.parse(expr, mode='eval').body) if expr else None
+        except (SyntaxError, FormulaError) as e:
+            self.root = None
+            self.error = str(e)
+
+    def _build(self, node):
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, (bool, int, float)):
+                value = float(node.value)
+                return lambda env: value
+            raise FormulaError(f"Unsupported constant {node.value!r}")
+        if isinstance(node, ast.Name):
+            if node.id not in self.slots:
+                raise FormulaError(f"Unknown name {node.id}")
+            slot = self.slots[node.id]
+            return lambda env: env[slot]
+        if isinstance(node, ast.BinOp) and type(node.op) in BIN_OPS:
+            op = BIN_OPS[type(node.op)]
+            left, right = self._build(node.left), self._build(node.right)
+            return lambda env: op(left(env), right(env))
+        if isinstance(node, ast.UnaryOp):
+            operand = self._build(node.operand)
+            if isinstance(node.op, ast.USub):
+                return lambda env: np.negative(operand(env))
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            if isinstance(node.op, ast.Not):
+                return lambda env: np.equal(operand(env), 0).astype(float)
+        if isinstance(node, ast.Compare) and all(type(op) in COMPARE_OPS for op in node.ops):
+            operands = [self._build(node.left)] + [self._build(c) for c in node.comparators]
+            ops = [COMPARE_OPS[type(op)] for op in node.ops]
+
+            def compare(env):
+                values = [o(env) for o in operands]
+                result = True
+                for op, a, b in zip(ops, values, values[1:]):
+                    result = np.logical_and(result, op(a, b))
+                return np.asarray(result, dtype=float)
+            return compare
+        if isinstance(node, ast.BoolOp):
+            values = [self._build(v) for v in node.values]
+            is_and = isinstance(node.op, ast.And)
+
+            def boolop(env):
+                result = values[0](env)
+                for v in values[1:]:
+                    other = v(env)
+                    result = np.where(result != 0, other, result) if is_and else np.where(result != 0, result, other)
+                return result
+            return boolop
+        if isinstance(node, ast.IfExp):
+            test, body, orelse = self._build(node.test), self._build(node.body), self._build(node.orelse)
+            return lambda env: np.where(test(env) != 0, body(env), orelse(env))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+            func = FUNCTIONS[node.func.id]
+            args = [self._build(a) for a in node.args]
+            if not args:
+                raise FormulaError(f"{node.func.id}() needs arguments")
+            return lambda env: func(*[a(env) for a in args])
+        raise FormulaError(f"Unsupported expression: {ast.dump(node)}")
+
+    def evaluate(self, inputs, length):
+        # inputs are float arrays aligned with the target rows, one per ref;
+        # non-finite inputs or results become 0 like a failed eval used to
+        if self.root is None:
+            return np.zeros(length)
+        with np.errstate(all='ignore'):
+            try:
+                result = self.root(inputs)
+            except (ValueError, TypeError, OverflowError):
+                return np.zeros(length)
+            result = np.array(np.broadcast_to(np.asarray(result, dtype=float), (length,)))
+        valid = np.isfinite(result)
+        for values in inputs:
+            valid &= np.isfinite(values)
+        result[~valid] = 0
+        return result
+
+
+@lru_cache(maxsize=None)
+def compile_formula(formula):
+    return CompiledFormula(formula)
+
+
+def parse_refs(formula):
+    return set(compile_formula(formula).refs)
+
+
+def numeric_values(series):
+    # Mirrors the old per-cell rule: bools count as 1/0, other numbers as is,
+    # anything that isn't a number (including missing values) counts as 0
+    if pd.api.types.is_bool_dtype(series.dtype) or pd.api.types.is_numeric_dtype(series.dtype):
+        return series.to_numpy(dtype=float, na_value=0.0)
+    if series.dtype != object:
+        return np.zeros(len(series))
+    is_num = series.map(lambda v: isinstance(v, (int, float, np.number, np.bool_))).to_numpy(dtype=bool)
+    values = np.zeros(len(series))
+    if is_num.any():
+        values[is_num] = series[is_num].to_numpy(dtype=float)
+    return values
+
+
+def cast_result(values, typ):
+    if typ == "boolean":
+        return pd.array(values != 0, dtype=DTYPES["boolean"])
+    if typ == "integer" and np.array_equal(values, np.trunc(values)):
+        return pd.array(values.astype(np.int64), dtype=DTYPES["integer"])
+    return pd.array(values, dtype=DTYPES["float"])
@@ -0,0 +1,313 @@
+# history.py
+from collections import deque
+import numpy as np
+import pandas as pd
+
+
+def estimate_nbytes(obj):
+    if obj is None:
+        return 0
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=False, deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=False, deep=True))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes if obj.dtype != object else obj.size * 64
+    return 64
+
+
+class CellPatch:
+    # Values of some rows of one column
+    def __init__(self, dm, col, rows, old, new):
+        self.dm = dm
+        self.col = col
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.old = np.asarray(old)
+        self.new = np.asarray(new)
+        self.nbytes = self.rows.nbytes + estimate_nbytes(self.old) + estimate_nbytes(self.new)
+
+    def apply(self):
+        self.dm.set_column_values(self.col, self.rows, self.new)
+
+    def revert(self):
+        self.dm.set_column_values(self.col, self.rows, self.old)
+
+
+class ColumnPatch:
+    # A whole column replaced, added (old is None) or dropped (new is None)
+    def __init__(self, dm, col, old, new, position):
+        self.dm = dm
+        self.col = col
+        self.old = old
+        self.new = new
+        self.position = position
+        self.nbytes = estimate_nbytes(old) + estimate_nbytes(new)
+
+    def _set(self, series):
+        df = self.dm.df
+        if series is None:
+            position = df.columns.get_loc(self.col)
+            df.drop(columns=[self.col], inplace=True)
+            self.dm.notify("column_removed", position)
+        elif self.col in df.columns:
+            df[self.col] = series.copy()
+            self.dm.notify("cells", self.col, None)
+        else:
+            df.insert(min(self.position, len(df.columns)), self.col, series.copy())
+            self.dm.notify("column_inserted", self.col)
+
+    def apply(self):
+        self._set(self.new)
+
+    def revert(self):
+        self._set(self.old)
+
+
+class RowPatch:
+    # Rows inserted at (removed=False) or removed from the given positions;
+    # dtypes are the column dtypes while the rows are absent, if known
+    def __init__(self, dm, positions, rows, removed, dtypes=None):
+        self.dm = dm
+        self.positions = np.asarray(sorted(positions), dtype=np.int64)
+        self.rows = rows
+        self.removed = removed
+        self.dtypes = dtypes
+        self.nbytes = self.positions.nbytes + estimate_nbytes(rows)
+
+    def _insert(self):
+        df = self.dm.df
+        total = len(df) + len(self.positions)
+        keep = np.setdiff1d(np.arange(total), self.positions)
+        combined = pd.concat([df, self.rows])
+        order = np.argsort(np.concatenate([keep, self.positions]), kind='stable')
+        self.dm.df = combined.iloc[order]
+        self.dm.notify("rows_inserted", self.positions)
+
+    def _remove(self):
+        df = self.dm.df
+        df = df.drop(index=df.index[self.positions])
+        if self.dtypes is not None:
+            widened = {c: t for c, t in self.dtypes.items() if c in df.columns and df[c].dtype != t}
+            if widened:
+                df = df.astype(widened)
+        self.dm.df = df
+        self.dm.notify("rows_removed", self.positions)
+
+    def apply(self):
+        if self.removed:
+            self._remove()
+        else:
+            self._insert()
+
+    def revert(self):
+        if self.removed:
+            self._insert()
+        else:
+            self._remove()
+
+
+class RenamePatch:
+    def __init__(self, dm, old_name, new_name):
+        self.dm = dm
+        self.old_name = old_name
+        self.new_name = new_name
+        self.nbytes = 64
+
+    def apply(self):
+        self.dm.df = self.dm.df.rename(columns={self.old_name: self.new_name})
+        self.dm.notify("column_renamed", self.old_name, self.new_name)
+
+    def revert(self):
+        self.dm.df = self.dm.df.rename(columns={self.new_name: self.old_name})
+        self.dm.notify("column_renamed", self.new_name, self.old_name)
+
+
+class FramePatch:
+    # Whole page replaced, e.g. by an import; the only full snapshot kind.
+    # The page only ever gets copy-on-write copies of the two frames, so
+    # later edits made in place can't leak into them.
+    def __init__(self, dm, old, new):
+        self.dm = dm
+        self.old = old
+        self.new = new.copy(deep=False)
+        self.nbytes = estimate_nbytes(old) + estimate_nbytes(new)
+
+    def apply(self):
+        self.dm.df = self.new.copy(deep=False)
+        self.dm.notify("reset")
+
+    def revert(self):
+        self.dm.df = self.old.copy(deep=False)
+        self.dm.notify("reset")
+
+
+class MetaPatch:
+    # Column types, formulas, tiers and plot columns of a page
+    def __init__(self, dm, before, after):
+        self.dm = dm
+        self.before = before
+        self.after = after
+        self.nbytes = 1024
+
+    def apply(self):
+        self.dm.restore_meta_state(self.after)
+
+    def revert(self):
+        self.dm.restore_meta_state(self.before)
+
+
+class PagePatch:
+    # A whole page added to (removed=False) or deleted from the session
+    def __init__(self, session, dm, index, removed):
+        self.session = session
+        self.dm = dm
+        self.index = index
+        self.removed = removed
+        self.nbytes = 1024
+
+    def _insert(self):
+        self.session.insert(self.index, self.dm)
+
+    def _remove(self):
+        del self.session[self.index]
+
+    def apply(self):
+        if self.removed:
+            self._remove()
+        else:
+            self._insert()
+
+    def revert(self):
+        if self.removed:
+            self._insert()
+        else:
+            self._remove()
+
+
+class PageRenamePatch:
+    def __init__(self, session, dm, old_name, new_name):
+        self.session = session
+        self.dm = dm
+        self.old_name = old_name
+        self.new_name = new_name
+        self.nbytes = 64
+
+    def apply(self):
+        self.session.set_page_name(self.dm, self.new_name)
+
+    def revert(self):
+        self.session.set_page_name(self.dm, self.old_name)
+
+
+class HistoryEntry:
+    # seq is the journal position when the entry was recorded, if known
+    def __init__(self, patches, seq=None):
+        self.patches = patches
+        self.nbytes = sum(p.nbytes for p in patches)
+        self.seq = seq
+        # Nodes whose dependents still wait for a background recompute after
+        # this entry; merged means one was already running when it was made
+        self.recompute = None
+        self.merged = False
+
+    def pages(self):
+        pages = []
+        for p in self.patches:
+            if not any(p.dm is d for d in pages):
+                pages.append(p.dm)
+        return pages
+
+    def apply(self):
+        for p in self.patches:
+            p.apply()
+        self._resync()
+
+    def revert(self):
+        for p in reversed(self.patches):
+            p.revert()
+        self._resync()
+
+    def _resync(self):
+        for dm in self.pages():
+            dm.resync()
+
+
+class UndoLog:
+    # Session-wide undo/redo of delta entries, trimmed oldest-first to
+    # stay within max_bytes and max_entries
+    MAX_BYTES = 256 * 1024 * 1024
+    MAX_ENTRIES = 500
+
+    def __init__(self, max_bytes=MAX_BYTES, max_entries=MAX_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.pending = []
+        self.nbytes = 0
+
+    def record(self, patch):
+        self.pending.append(patch)
+
+    def commit(self, seq=None):
+        if not self.pending:
+            return None
+        entry = HistoryEntry(self.pending, seq)
+        self.pending = []
+        for old in self.redo_stack:
+            self.nbytes -= old.nbytes
+        self.redo_stack = []
+        self.undo_stack.append(entry)
+        self.nbytes += entry.nbytes
+        self.evict()
+        return entry
+
+    def amend(self):
+        # Folds the pending patches into the newest entry, e.g. results of a
+        # background recompute, so they are undone together with it
+        if not self.pending:
+            return
+        if not self.undo_stack:
+            self.pending = []
+            return
+        entry = self.undo_stack[-1]
+        nbytes = sum(p.nbytes for p in self.pending)
+        entry.patches.extend(self.pending)
+        entry.nbytes += nbytes
+        self.nbytes += nbytes
+        self.pending = []
+        self.evict()
+
+    def set_limits(self, max_bytes=None, max_entries=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if max_entries is not None:
+            self.max_entries = max_entries
+        self.evict()
+
+    def evict(self):
+        while self.undo_stack and (self.nbytes > self.max_bytes or len(self.undo_stack) > self.max_entries):
+            self.nbytes -= self.undo_stack.popleft().nbytes
+
+    def undo(self):
+        self.commit()
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        entry.revert()
+        self.redo_stack.append(entry)
+        return entry.pages()
+
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        entry.apply()
+        self.undo_stack.append(entry)
+        return entry.pages()
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack = []
+        self.pending = []
+        self.nbytes = 0
@@ -0,0 +1,239 @@
+# journal.py
+import json
+import os
+import threading
+import pandas as pd
+from PyQt5.QtCore import QObject, pyqtSignal
+import data_model
+import session_store
+
+# DataModel methods that can be replayed straight from their journaled args
+DATA_MODEL_OPS = {
+    "add_model", "bulk_add_models", "add_column", "rename_column", "change_column_type",
+    "set_column_formula", "delete_column", "set_plot_columns",
+}
+
+
+def frame_from_json(data):
+    return pd.DataFrame(data['data'], columns=data['columns']).astype(data['dtypes'])
+
+
+def _json_default(obj):
+    if isinstance(obj, pd.DataFrame):
+        data = json.loads(obj.to_json(orient='split', index=False))
+        data['dtypes'] = {c: str(t) for c, t in obj.dtypes.items()}
+        return data
+    if hasattr(obj, 'item'):
+        return obj.item()
+    return str(obj)
+
+
+def apply_entry(session, entry):
+    op, page, args = entry['op'], entry['page'], entry['args']
+    if op == "new_session":
+        del session[:]
+        session.history.clear()
+        session.append(data_model.DataModel())
+        return
+    if op == "add_page":
+        dm = data_model.DataModel()
+        dm.page_name = page
+        dm.df = frame_from_json(args[0])
+        dm.column_types = dict(args[1])
+        dm.reindex_rows()
+        session.add_page(dm)
+        return
+    if op == "restore_pages":
+        session.restore_pages(args[0], [(old, name, frame_from_json(df), meta) for old, name, df, meta in args[1]])
+        return
+    if op == "undo":
+        session.undo()
+        return
+    if op == "redo":
+        session.redo()
+        return
+    dm = next((d for d in session if d.page_name == page), None)
+    if dm is None:
+        raise KeyError(f"Page {page} not found.")
+    if op == "remove_page":
+        session.remove_page(session.index(dm))
+    elif op == "rename_page":
+        session.rename_page(dm, args[0])
+    # Rows are journaled by position; row ids are only meaningful in-process
+    elif op == "update_cell":
+        dm.update_cell(dm.df.index[args[0]], *args[1:])
+    elif op == "bulk_update":
+        dm.bulk_update([(dm.df.index[p], h, v) for p, h, v in args[0]])
+    elif op == "remove_rows":
+        dm.remove_rows(dm.df.index[args[0]])
+    elif op == "set_column_tiers":
+        dm.set_column_tiers(args[0], args[1], [tuple(t) for t in args[2]])
+    elif op == "upsert_data":
+        dm.upsert_data(frame_from_json(args[0]), args[1])
+    elif op == "replace_data":
+        dm.replace_data(frame_from_json(args[0]))
+        dm.recompute_all_computed()
+        dm.save_to_history()
+    elif op in DATA_MODEL_OPS:
+        getattr(dm, op)(*args)
+    else:
+        raise KeyError(f"Unknown journal operation {op}.")
+
+
+class JournalSignals(QObject):
+    # Emitted from the writer thread; connections run on the GUI thread.
+    # saved tells whether the write was an explicit save.
+    failed = pyqtSignal(str)
+    progress = pyqtSignal(int, int)
+    saved = pyqtSignal(bool)
+
+
+class Journal:
+    # Append-only log of session mutations kept next to the session file.
+    # Entries newer than the session file's journal_seq are replayed on
+    # startup; a clean shutdown removes the file.
+    COMPACT_EVERY = 500
+
+    def __init__(self, session_file):
+        self.session_file = session_file
+        self.path = session_file + ".journal"
+        self.lock = threading.Lock()
+        self.file = None
+        self.seq = 0
+        self.base_seq = 0
+        self.compactor = None
+        self.compacting = False
+        self.queued = None
+        self.checkpoint_seq = 0  # newest seq a written or pending session file holds
+        self.checkpoint_stale = False  # whether that file waits on a recompute
+        self.error = None  # why the last write failed
+        self.skipped = []
+        self.signals = JournalSignals()
+
+    def read_entries(self):
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break  # torn write from a crash, nothing valid after it
+        return entries
+
+    def replay(self, session):
+        self.base_seq = self.checkpoint_seq = session.journal_seq
+        self.checkpoint_stale = session.needs_recompute
+        entries = [e for e in self.read_entries() if e['seq'] > self.base_seq]
+        self.skipped = []
+        for entry in entries:
+            try:
+                apply_entry(session, entry)
+            except (ValueError, KeyError, IndexError) as e:
+                self.skipped.append(f"{entry['op']} on {entry['page']}: {e}")
+        self.seq = max([self.base_seq] + [e['seq'] for e in entries])
+        return len(entries)
+
+    def covers(self, seq):
+        # Whether the op recorded after journal position seq is still in the
+        # journal and not folded into a session file
+        return seq is not None and seq > self.checkpoint_seq
+
+    def attach(self, session):
+        session.journal = self
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+
+    def append(self, session, op, page, *args):
+        if self.file is None:
+            return
+        self.seq += 1
+        line = json.dumps({'seq': self.seq, 'op': op, 'page': page, 'args': list(args)}, default=_json_default)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+        if not self.compacting and self.seq - self.base_seq >= self.COMPACT_EVERY:
+            self.compact(session)
+
+    def up_to_date(self):
+        # Whether the written or pending session file holds every change
+        return self.checkpoint_seq == self.seq and not self.checkpoint_stale
+
+    def compact(self, session, manual=False):
+        # Snapshot on the caller's thread, write the session file in the
+        # background; a snapshot taken while a write is running is queued
+        # behind it, replacing any older queued one. Snapshots are shallow:
+        # the pages' data is shared copy-on-write, so later edits don't
+        # reach them.
+        stale = session.runner is not None and session.runner.busy()
+        job = [[dm.snapshot(deep=False) for dm in session], self.seq, stale, manual]
+        self.checkpoint_seq = self.seq
+        self.checkpoint_stale = stale
+        with self.lock:
+            if self.compacting:
+                if self.queued is not None:
+                    job[3] = job[3] or self.queued[3]
+                self.queued = job
+                return
+            self.compacting = True
+        self.compactor = threading.Thread(target=self._run, args=(job,), daemon=True)
+        self.compactor.start()
+
+    def _run(self, job):
+        while job is not None:
+            dms, seq, stale, manual = job
+            try:
+                self._write_base(dms, seq, stale)
+                self.error = None
+                self.signals.saved.emit(manual)
+            except OSError as e:
+                self.error = str(e)
+                what = "Session could not be saved" if manual else "Autosave could not write the session file"
+                self.signals.failed.emit(f"{what}: {e}\nChanges are still kept in the journal.")
+            with self.lock:
+                job, self.queued = self.queued, None
+                if job is None:
+                    self.compacting = False
+
+    def _write_base(self, dms, seq, stale=False):
+        session_store.save_session(dms, self.session_file, journal_seq=seq, stale=stale, progress=self.signals.progress.emit)
+        self.truncate(seq)
+
+    def truncate(self, seq):
+        # Drop entries the session file already contains
+        with self.lock:
+            keep = [e for e in self.read_entries() if e['seq'] > seq]
+            was_open = self.file is not None
+            if was_open:
+                self.file.close()
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                for e in keep:
+                    f.write(json.dumps(e) + '\n')
+            os.replace(tmp, self.path)
+            self.file = open(self.path, 'a', encoding='utf-8') if was_open else None
+            self.base_seq = seq
+
+    def wait(self):
+        if self.compactor is not None:
+            self.compactor.join()
+
+    def save(self, session):
+        # An explicit save, written in the background like compaction
+        self.compact(session, manual=True)
+
+    def discard(self):
+        # Forget unsaved entries, e.g. when the session is reloaded from disk
+        self.wait()
+        self.checkpoint_seq = self.seq
+        self.truncate(self.seq)
+
+    def close(self):
+        self.wait()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
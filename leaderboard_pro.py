@@ -1,6 +1,5 @@
 # leaderboard_pro.py
 import sys
-import os
 import pandas as pd
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QMessageBox, QLabel, QMenu, QAction, QDialog, QVBoxLayout, QCheckBox, QPushButton, QListWidget, QListWidgetItem, QWidget, QHBoxLayout
@@ -18,12 +17,13 @@ from table_handler import TableHandler
 from style_handler import StyleHandler
 from chart_handler import ChartHandler
 from action_handler import ActionHandler
-from file_io import load_multi, save_multi
+from session_store import open_session
+from journal import Journal
+from recompute_worker import RecomputeRunner
+from history import UndoLog
 
 
 class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
-    DF_ROW_ROLE = Qt.UserRole + 1
-
     def __init__(self):
         super().__init__()
         self.setupUi(self)
@@ -31,20 +31,38 @@ class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
         self.font_family = "Verdana"
         self.chart_base_font_size = 12
         self.current_view = "Table"
-        self.has_been_sorted = False
-        self.current_sort_col = 0
-        self.current_sort_order = Qt.AscendingOrder
         self.show_legends = True
+        self.legend_widgets = {}
+        self.undo_memory_mb = UndoLog.MAX_BYTES // (1024 * 1024)
 
-        self.data_models = load_multi(data_model.DataModel.SESSION_FILE) if os.path.exists(data_model.DataModel.SESSION_FILE) else [data_model.DataModel()]
+        self.data_models = open_session(data_model.DataModel.SESSION_FILE, data_model.DataModel.LEGACY_SESSION_FILE)
 
         for dm in self.data_models:
             dm.all_data_models = self.data_models
             self.page_selector.addItem(dm.page_name)
 
-        # Recompute after all models are loaded and all_data_models is set
-        if self.data_models:
+        # Computed values come saved with the pages, unless the file was
+        # written while a recompute was still running
+        if self.data_models.needs_recompute:
             self.data_models[0].recompute_all_computed()
+        self.data_models.history.clear()
+        self.apply_undo_limit()
+
+        # A journal left behind means the last run did not shut down cleanly
+        self.journal = Journal(data_model.DataModel.SESSION_FILE)
+        self.journal.signals.failed.connect(self.show_journal_error)
+        self.journal.signals.progress.connect(self.show_save_progress)
+        self.journal.signals.saved.connect(self.on_session_saved)
+        recovered = self.journal.replay(self.data_models)
+        self.journal.attach(self.data_models)
+        self.attach_runner()
+        if self.journal.skipped:
+            QMessageBox.warning(self, "Recovery Incomplete", f"{len(self.journal.skipped)} unsaved change(s) could not be recovered:\n\n" + "\n".join(self.journal.skipped[:10]))
+        if recovered:
+            self.page_selector.clear()
+            for dm in self.data_models:
+                self.page_selector.addItem(dm.page_name)
+            self.journal.compact(self.data_models)
 
         self.current_page = 0
         self.page_selector.setCurrentIndex(0)
@@ -61,9 +79,9 @@ class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
         self.apply_styles()
         self.refresh_table()
         self.change_view(self.current_view)
-        self.update_legends()
 
         self.undo_action = QAction("Undo", self)
+        self.redo_action = QAction("Redo", self)
         self.open_action = QAction("Open", self)
         self.save_action = QAction("Save", self)
         self.reload_action = QAction("Reload", self)
@@ -86,6 +104,7 @@ class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
         self.file_menu.addAction(self.export_action)
         self.file_menu.addAction(self.save_action)
         self.file_menu.addAction(self.undo_action)
+        self.file_menu.addAction(self.redo_action)
         self.file_menu.addAction(self.reload_action)
         self.file_menu.addAction(self.new_session_action)
 
@@ -113,6 +132,9 @@ class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
         self.toggle_legends_action.setChecked(True)
         self.toggle_legends_action.triggered.connect(self.toggle_legends)
         self.view_menu.addAction(self.toggle_legends_action)
+        self.filter_action = QAction("Filter Models", self)
+        self.filter_action.triggered.connect(lambda: self.filter_input.setFocus())
+        self.view_menu.addAction(self.filter_action)
 
         # Add Page menu
         self.page_menu = QMenu("Page", self)
@@ -179,23 +201,70 @@ class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
         dlg.setLayout(layout)
         if dlg.exec_() == QDialog.Accepted:
             selected = [item.text() for item in list_widget.selectedItems()]
-            self.data_model.plot_columns = selected
+            self.data_model.set_plot_columns(selected)
             self.update_chart()
 
     def toggle_legends(self, checked):
         self.show_legends = checked
         self.change_view(self.current_view)
 
+    def sync_pages(self):
+        # Undo/redo can add, remove or rename pages
+        current = self.data_model
+        self.page_selector.blockSignals(True)
+        self.page_selector.clear()
+        for dm in self.data_models:
+            self.page_selector.addItem(dm.page_name)
+        index = next((i for i, dm in enumerate(self.data_models) if dm is current), min(self.current_page, len(self.data_models) - 1))
+        self.page_selector.setCurrentIndex(index)
+        self.page_selector.blockSignals(False)
+        self.current_page = index
+        self.data_model = self.data_models[index]
+
     def change_page(self, index):
+        # change_view redraws the chart or the legends, whichever is shown
         self.current_page = index
         self.data_model = self.data_models[index]
         self.refresh_table()
-        self.update_chart()
-        self.update_legends()
         self.change_view(self.current_view)
 
+    def attach_runner(self):
+        # Large recomputes of the session run on a worker thread from here on
+        runner = RecomputeRunner(self.data_models)
+        runner.signals.progressed.connect(self.show_recompute_progress)
+        runner.signals.settled.connect(self.on_recompute_settled)
+        self.data_models.runner = runner
+
+    def show_recompute_progress(self, done, total):
+        self.recompute_progress.setRange(0, total)
+        self.recompute_progress.setValue(done)
+        self.recompute_progress.show()
+
+    def on_recompute_settled(self):
+        self.recompute_progress.hide()
+        self.update_chart()
+
+    def show_save_progress(self, done, total):
+        self.save_progress.setRange(0, total)
+        self.save_progress.setValue(done)
+        self.save_progress.show()
+
+    def on_session_saved(self, manual):
+        self.save_progress.hide()
+        if manual:
+            self.statusBar().showMessage("Session saved.", 5000)
+
+    def show_journal_error(self, message):
+        self.save_progress.hide()
+        self.statusBar().clearMessage()
+        QMessageBox.warning(self, "Save Failed", message)
+
+    def apply_undo_limit(self):
+        self.data_models.history.set_limits(max_bytes=self.undo_memory_mb * 1024 * 1024)
+
     def apply_styles(self):
         self.style_handler.apply_styles()
+        self.table_handler.on_font_changed()
 
     def refresh_table(self):
         self.table_handler.refresh_table()
@@ -210,6 +279,8 @@ class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
         self.current_view = view
         if view == "Table":
             self.table.show()
+            self.filter_input.show()
+            self.filter_count.show()
             self.canvas.hide()
             self.chart_type_selector.hide()
             self.update_legends()
@@ -219,15 +290,23 @@ class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
                 self.right_widget.hide()
         else:
             self.table.hide()
+            self.filter_input.hide()
+            self.filter_count.hide()
             self.canvas.show()
             self.chart_type_selector.show()
             self.right_widget.hide()
             self.update_chart()
 
     def reload_session(self):
-        self.data_models = load_multi(data_model.DataModel.SESSION_FILE)
-        for dm in self.data_models:
-            dm.all_data_models = self.data_models
+        self.data_models.runner.cancel()
+        self.journal.discard()
+        self.data_models = open_session(data_model.DataModel.SESSION_FILE)
+        if self.data_models.needs_recompute:
+            self.data_models[0].recompute_all_computed()
+        self.data_models.history.clear()
+        self.apply_undo_limit()
+        self.journal.attach(self.data_models)
+        self.attach_runner()
         self.page_selector.clear()
         for dm in self.data_models:
             self.page_selector.addItem(dm.page_name)
@@ -240,9 +319,11 @@ class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
     def new_session(self):
         reply = QMessageBox.question(self, "New Session", "Are you sure you want to start a new session? Unsaved changes will be lost.", QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         if reply == QMessageBox.Yes:
-            self.data_models = [data_model.DataModel()]
-            for dm in self.data_models:
-                dm.all_data_models = self.data_models
+            self.data_models.runner.cancel()
+            self.data_models = data_model.Session([data_model.DataModel()], self.undo_memory_mb * 1024 * 1024)
+            self.journal.attach(self.data_models)
+            self.attach_runner()
+            self.data_models.log_op("new_session", None)
             self.page_selector.clear()
             self.page_selector.addItem("Default")
             self.current_page = 0
@@ -257,6 +338,9 @@ class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
     def undo(self):
         self.action_handler.undo()
 
+    def redo(self):
+        self.action_handler.redo()
+
     def import_data(self):
         self.action_handler.import_data()
 
@@ -268,7 +352,18 @@ class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
         self.bg.setGeometry(self.rect())
 
     def closeEvent(self, event):
-        save_multi(self.data_models, data_model.DataModel.SESSION_FILE)
+        self.data_models.runner.settle()
+        # A save that is already running may hold everything; only changes
+        # made since (or a failed write) need a write of their own
+        if not self.journal.up_to_date() or self.journal.error is not None:
+            self.journal.compact(self.data_models)
+        self.journal.wait()
+        if self.journal.error is not None:
+            # Keep the journal so the changes are recovered on next start
+            QMessageBox.warning(self, "Save Failed", f"Session could not be saved: {self.journal.error}\nUnsaved changes will be recovered on next start.")
+            event.accept()
+            return
+        self.journal.close()
         event.accept()
 
     def change_font_size(self):
@@ -278,33 +373,45 @@ class LeaderboardPro(QMainWindow, Ui_LeaderboardPro):
         self.style_handler.change_font_family()
 
     def update_legends(self):
+        # One widget per column and tier config, reused across pages and
+        # redraws; only a config not seen before builds a new one
         layout = self.control_layout
         while layout.count() > 0:
-            item = layout.takeAt(0)
-            widget = item.widget()
+            widget = layout.takeAt(0).widget()
             if widget:
-                widget.deleteLater()
+                widget.hide()
+        used = set()
+        for dm in self.data_models:
+            used.update(self.legend_key(col, config) for col, config in dm.column_tiers.items())
+        for key in [key for key in self.legend_widgets if key not in used]:
+            self.legend_widgets.pop(key).deleteLater()
         for col in sorted(self.data_model.column_tiers.keys()):
-            widget = QWidget()
-            wlayout = QVBoxLayout(widget)
-            title = QLabel(f"{col} Color Legend")
-            title.setStyleSheet("color: #3498db; font-weight: bold;")
-            wlayout.addWidget(title)
-            is_min_threshold, tiers = self.data_model.column_tiers[col]
-            if is_min_threshold:
-                for _, text, color in tiers:
-                    label = QLabel(text)
-                    label.setStyleSheet(f"color: {color};")
-                    wlayout.addWidget(label)
-            else:
-                for _, _, text, color in tiers:
-                    label = QLabel(text)
-                    label.setStyleSheet(f"color: {color};")
-                    wlayout.addWidget(label)
-            widget.setStyleSheet("background-color: rgba(17,17,17,128); border: 1px solid #3498db; border-radius: 5px;")
+            key = self.legend_key(col, self.data_model.column_tiers[col])
+            widget = self.legend_widgets.get(key)
+            if widget is None:
+                widget = self.legend_widgets[key] = self.build_legend(col, self.data_model.column_tiers[col][1])
             layout.addWidget(widget)
+            widget.show()
         layout.addStretch()
 
+    def legend_key(self, col, config):
+        mode, tiers = config
+        return (col, mode, tuple(tuple(t) for t in tiers))
+
+    def build_legend(self, col, tiers):
+        widget = QWidget()
+        wlayout = QVBoxLayout(widget)
+        title = QLabel(f"{col} Color Legend")
+        title.setStyleSheet("color: #3498db; font-weight: bold;")
+        wlayout.addWidget(title)
+        # Every tier ends with its label text and color
+        for tier in tiers:
+            label = QLabel(tier[-2])
+            label.setStyleSheet(f"color: {tier[-1]};")
+            wlayout.addWidget(label)
+        widget.setStyleSheet("background-color: rgba(17,17,17,128); border: 1px solid #3498db; border-radius: 5px;")
+        return widget
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     palette = QPalette()
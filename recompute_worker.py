@@ -0,0 +1,134 @@
+# recompute_worker.py
+import numpy as np
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+import formula_engine
+import data_model
+
+
+class RecomputeSignals(QObject):
+    # done and progress are emitted from the pool thread with the job's
+    # generation; progressed and settled are the runner's, on the GUI thread
+    done = pyqtSignal(int, object)
+    progress = pyqtSignal(int, int, int)
+    progressed = pyqtSignal(int, int)
+    settled = pyqtSignal()
+
+
+class RecomputeJob(QRunnable):
+    # Evaluates the planned columns on shallow copies of the pages, which
+    # share their data copy-on-write and don't see later edits
+    def __init__(self, generation, pages, plan, signals):
+        super().__init__()
+        self.generation = generation
+        self.pages = pages
+        self.plan = plan
+        self.signals = signals
+        self.cancelled = False
+
+    def run(self):
+        try:
+            results = self.compute()
+        except Exception:
+            results = None  # the runner redoes the plan on the GUI thread
+        if not self.cancelled:
+            self.signals.done.emit(self.generation, results)
+
+    def compute(self):
+        session = data_model.Session(self.pages)
+        session.dep_graph.topo_order()
+        cyclic = session.dep_graph.cyclic
+        results = {}
+        for done, full in enumerate(self.plan, 1):
+            if self.cancelled:
+                return None
+            page, col = full.split(':', 1)
+            dm = session.page(page)
+            if dm is None or col not in dm.column_formulas:
+                continue
+            if full in cyclic:
+                values = formula_engine.cast_result(np.zeros(len(dm.df)), dm.column_types.get(col))
+            else:
+                values = dm.computed_values(col)
+            dm.df[col] = values
+            results[full] = values
+            self.signals.progress.emit(self.generation, done, len(self.plan))
+        return results
+
+
+class RecomputeRunner:
+    # Recomputes that cover whole columns of large pages (imports, page
+    # deletes and renames, new formulas, type changes) run in the
+    # background so the window stays usable. Results land in one go and
+    # join the newest undo entry. Any commit, undo or redo while a job is
+    # out makes it stale: it is cancelled and a fresh one recomputes every
+    # computed column from the current state.
+    BACKGROUND_CELLS = 200000
+
+    def __init__(self, session, pool=None):
+        self.session = session
+        self.pool = pool or QThreadPool.globalInstance()
+        self.signals = RecomputeSignals()
+        self.signals.done.connect(self.on_done)
+        self.signals.progress.connect(self.on_progress)
+        self.generation = 0
+        self.job = None
+
+    def busy(self):
+        return self.job is not None
+
+    def should_defer(self, changed):
+        if self.busy():
+            return True
+        if not any(rows is None for rows in changed.values()):
+            return False
+        cells = 0
+        for full in self.session.recompute_plan(changed):
+            dm = self.session.page(full.split(':', 1)[0])
+            cells += dm.row_count() if dm is not None else 0
+        return cells >= self.BACKGROUND_CELLS
+
+    def start(self, nodes):
+        # nodes are the changed "Page:Col" names, None for everything
+        self.cancel()
+        plan = self.session.recompute_plan(nodes)
+        if not plan:
+            self.signals.settled.emit()
+            return
+        self.generation += 1
+        pages = [dm.snapshot(deep=False) for dm in self.session]
+        self.job = RecomputeJob(self.generation, pages, plan, self.signals)
+        self.signals.progressed.emit(0, len(plan))
+        self.pool.start(self.job)
+
+    def cancel(self):
+        if self.job is not None:
+            self.job.cancelled = True
+            self.job = None
+
+    def on_progress(self, generation, done, total):
+        if self.job is not None and generation == self.job.generation:
+            self.signals.progressed.emit(done, total)
+
+    def on_done(self, generation, results):
+        if self.job is None or generation != self.job.generation:
+            return
+        plan = self.job.plan
+        self.job = None
+        if results is None:
+            results = self.compute_here(plan)
+        self.session.land_recompute(results)
+        self.signals.settled.emit()
+
+    def compute_here(self, plan):
+        job = RecomputeJob(self.generation, [dm.snapshot(deep=False) for dm in self.session], plan, self.signals)
+        return job.compute()
+
+    def settle(self):
+        # Finish a pending recompute right here, e.g. before the session is
+        # written out
+        if self.job is None:
+            return
+        plan = self.job.plan
+        self.cancel()
+        self.session.land_recompute(self.compute_here(plan))
+        self.signals.settled.emit()
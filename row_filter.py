@@ -0,0 +1,166 @@
+# row_filter.py
+import re
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from column_dtypes import TRUE_STRINGS, FALSE_STRINGS
+
+# Filter text is a list of terms that must all match: words search model
+# names (^word for a prefix), conditions like score>=50, {Pass Rate}<0.5
+# or passed=true test a column
+TERM = re.compile(r'''(?:\{(?P<braced>[^}]+)\}|(?P<bare>[^\s<>=!{}"]+))\s*(?P<op>>=|<=|!=|==|=|>|<)\s*(?:"(?P<quoted>[^"]*)"|(?P<value>[^\s"]+))|"(?P<phrase>[^"]*)"|(?P<word>\S+)''')
+
+OPS = {
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    "=": np.equal,
+    "==": np.equal,
+    "!=": np.not_equal,
+}
+
+# Marks the start of every indexed name so prefixes have trigrams of their own
+START = "\x02"
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NameIndex:
+    # Trigram -> ids of the rows whose name contains it. A search only
+    # checks the names that share all of the term's trigrams.
+    def __init__(self, names):
+        self.keys = {}
+        self.grams = defaultdict(set)
+        for row_id, name in names.items():
+            self.add(row_id, name)
+
+    def add(self, row_id, name):
+        self.remove(row_id)
+        key = START + ('' if pd.isna(name) else str(name)).lower()
+        self.keys[row_id] = key
+        for gram in trigrams(key):
+            self.grams[gram].add(row_id)
+
+    def remove(self, row_id):
+        key = self.keys.pop(row_id, None)
+        if key is None:
+            return
+        for gram in trigrams(key):
+            ids = self.grams[gram]
+            ids.discard(row_id)
+            if not ids:
+                del self.grams[gram]
+
+    def retain(self, row_ids):
+        for row_id in self.keys.keys() - set(row_ids):
+            self.remove(row_id)
+
+    def search(self, term, prefix=False):
+        # None when the term is too short to have a trigram
+        key = (START if prefix else '') + term
+        grams = trigrams(key)
+        if not grams:
+            return None
+        sets = sorted((self.grams.get(gram, set()) for gram in grams), key=len)
+        found = sets[0].intersection(*sets[1:])
+        return {row_id for row_id in found if key in self.keys[row_id]}
+
+
+class Condition:
+    def __init__(self, column, op, value):
+        self.column = column
+        self.op = op
+        self.value = value
+
+    def resolve(self, dm):
+        if self.column in dm.df.columns:
+            return self.column
+        matches = [col for col in dm.df.columns if col.lower() == self.column.lower()]
+        if len(matches) != 1:
+            raise ValueError(f"Unknown column '{self.column}'.")
+        return matches[0]
+
+    def mask(self, dm):
+        col = self.resolve(dm)
+        typ = dm.column_types.get(col)
+        if typ == "boolean":
+            value = self.value.lower()
+            if value not in TRUE_STRINGS and value not in FALSE_STRINGS:
+                raise ValueError(f"'{self.value}' is not true or false.")
+            target = 1.0 if value in TRUE_STRINGS else 0.0
+        elif typ in ("integer", "float"):
+            try:
+                target = float(self.value)
+            except ValueError:
+                raise ValueError(f"'{self.value}' is not a number.")
+        else:
+            if self.op not in ("=", "==", "!="):
+                raise ValueError(f"'{self.op}' needs a numeric column, '{col}' is {typ}.")
+            equal = (dm.df[col].fillna('').astype(str).str.lower() == self.value.lower()).to_numpy(dtype=bool)
+            return ~equal if self.op == "!=" else equal
+        values = dm.df[col].to_numpy(dtype=float, na_value=np.nan)
+        return ~np.isnan(values) & OPS[self.op](values, target)
+
+
+class RowFilter:
+    def __init__(self, text):
+        self.words = []
+        self.conditions = []
+        for match in TERM.finditer(text):
+            if match.group("op"):
+                value = match.group("quoted") if match.group("quoted") is not None else match.group("value")
+                self.conditions.append(Condition(match.group("braced") or match.group("bare"), match.group("op"), value))
+                continue
+            word = match.group("phrase") if match.group("phrase") is not None else match.group("word")
+            if match.group("word") and re.search(r'[<>=!{}]', word):
+                raise ValueError(f"Incomplete condition '{word}'.")
+            prefix = word.startswith("^") and match.group("word") is not None
+            word = (word[1:] if prefix else word).lower()
+            if word:
+                self.words.append((word, prefix))
+
+    def is_empty(self):
+        return not self.words and not self.conditions
+
+    def columns(self, dm):
+        cols = {dm.model_col_name} if self.words else set()
+        for condition in self.conditions:
+            try:
+                cols.add(condition.resolve(dm))
+            except ValueError:
+                pass
+        return cols
+
+    def mask(self, dm, name_index, strict=False):
+        # strict raises on conditions that don't fit the page; otherwise
+        # such a condition just matches nothing
+        mask = self.name_mask(dm, name_index)
+        for condition in self.conditions:
+            try:
+                mask &= condition.mask(dm)
+            except ValueError:
+                if strict:
+                    raise
+                mask[:] = False
+        return mask
+
+    def name_mask(self, dm, name_index):
+        mask = np.ones(len(dm.df), dtype=bool)
+        ids = None
+        names = None
+        for word, prefix in self.words:
+            found = name_index.search(word, prefix)
+            if found is not None:
+                ids = found if ids is None else ids & found
+                continue
+            # Too short to look up, scan the names instead
+            if names is None:
+                names = dm.df[dm.model_col_name].fillna('').astype(str).str.lower()
+            matched = names.str.startswith(word) if prefix else names.str.contains(word, regex=False)
+            mask &= matched.to_numpy(dtype=bool)
+        if ids is not None:
+            mask &= dm.df.index.isin(list(ids))
+        return mask
@@ -0,0 +1,249 @@
+# session_store.py
+import json
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+import formula_engine
+import data_model
+import file_io
+
+# Sessions are SQLite files holding each page column by column: typed
+# values as one packed array plus a missing-value mask, strings as JSON.
+# Page settings are JSON documents; FORMAT_VERSION goes up whenever their
+# layout changes. Each page's stamp names the DataModel and data version it
+# was written from, so a save only replaces pages that changed since.
+FORMAT_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE session (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE pages (position INTEGER, name TEXT PRIMARY KEY, rows INTEGER, stamp TEXT, meta TEXT);
+CREATE TABLE columns (page TEXT, position INTEGER, name TEXT, dtype TEXT, data BLOB, mask BLOB, PRIMARY KEY (page, name));
+"""
+
+# pandas dtype -> numpy dtype of the packed values
+PACKED = {
+    "Int64": np.int64,
+    "Float64": np.float64,
+    "boolean": np.bool_,
+}
+
+
+def encode_column(series):
+    dtype = str(series.dtype)
+    missing = series.isna().to_numpy()
+    if dtype in PACKED:
+        values = series.to_numpy(dtype=PACKED[dtype], na_value=PACKED[dtype](0))
+        return dtype, values.tobytes(), np.packbits(missing).tobytes()
+    # Strings and anything left untyped (e.g. a widened object column)
+    values = [None if m else (v.item() if hasattr(v, 'item') else v) for v, m in zip(series.tolist(), missing)]
+    return dtype, json.dumps(values, default=str).encode('utf-8'), None
+
+
+def decode_column(dtype, data, mask, rows):
+    if dtype in PACKED:
+        values = pd.array(np.frombuffer(data, dtype=PACKED[dtype], count=rows).copy(), dtype=dtype)
+        values[np.unpackbits(np.frombuffer(mask, dtype=np.uint8), count=rows).astype(bool)] = pd.NA
+        return values
+    values = json.loads(data.decode('utf-8'))
+    try:
+        return pd.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        return pd.array(values, dtype=object)
+
+
+class PageSource:
+    # Where a page that hasn't been loaded yet lives in the session file.
+    # Each read opens the file afresh: whatever is at the path then holds
+    # the same page, as a page is loaded before it is changed or renamed.
+    def __init__(self, path, page, rows, columns):
+        self.path = path
+        self.page = page
+        self.rows = rows
+        self.columns = columns
+
+    def index(self):
+        return pd.RangeIndex(self.rows)
+
+    def fetch(self, names=None):
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            query = "SELECT name, dtype, data, mask FROM columns WHERE page = ?"
+            if names is not None:
+                query += f" AND name IN ({', '.join('?' * len(names))})"
+            return conn.execute(query + " ORDER BY position", [self.page] + list(names or [])).fetchall()
+        finally:
+            conn.close()
+
+    def read(self, names):
+        if not names:
+            return {}
+        return {col: pd.Series(decode_column(dtype, data, mask, self.rows), index=self.index(), name=col) for col, dtype, data, mask in self.fetch(names)}
+
+
+def page_meta(dm):
+    return {
+        "columns": dm.columns().tolist(),
+        "types": dm.column_types,
+        "formulas": dm.column_formulas,
+        "tiers": {c: [mode, [list(t) for t in tiers]] for c, (mode, tiers) in dm.column_tiers.items()},
+        "plot_columns": dm.plot_columns,
+    }
+
+
+def page_columns(dm):
+    # Encoded columns of a page; one never loaded is copied as stored
+    if dm.source is not None:
+        return dm.source.fetch()
+    return [(col,) + encode_column(dm.df[col]) for col in dm.df.columns]
+
+
+def page_stamp(dm):
+    return f"{dm.uid}:{dm.data_version}"
+
+
+def file_format(path):
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        row = conn.execute("SELECT value FROM session WHERE key = 'format_version'").fetchone()
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+    return int(row[0]) if row else None
+
+
+def sync_dir(path):
+    # Makes a rename durable; only POSIX can open a directory for this
+    if os.name != 'posix':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save_session(dms, path, journal_seq=None, stale=False, progress=None):
+    # Brings the file up to date in one transaction, replacing only the
+    # pages whose data changed and the settings that differ. A missing file
+    # or one in an older format is written afresh next to it, synced and
+    # swapped in. stale: computed columns may lag behind their inputs (a
+    # recompute was still running) and are recomputed when the file is
+    # loaded. progress is called with (pages done, pages).
+    try:
+        if file_format(path) == FORMAT_VERSION:
+            write_pages(path, dms, journal_seq, stale, progress)
+            return
+        root, ext = os.path.splitext(path)
+        tmp = root + ".tmp" + ext
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        write_pages(tmp, dms, journal_seq, stale, progress, fresh=True)
+        os.replace(tmp, path)
+        sync_dir(path)
+    except sqlite3.Error as e:
+        raise OSError(f"{path}: {e}") from e
+
+
+def write_pages(path, dms, journal_seq, stale, progress=None, fresh=False):
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        # The commit is on disk (file and rollback journal synced) before
+        # the journal is truncated
+        conn.execute("PRAGMA synchronous = FULL")
+        if fresh:
+            conn.executescript(SCHEMA)
+        stored = {name: (position, stamp, meta) for position, name, stamp, meta in conn.execute("SELECT position, name, stamp, meta FROM pages")}
+        pages = []
+        for position, dm in enumerate(dms):
+            old = stored.get(dm.page_name)
+            meta = json.dumps(page_meta(dm))
+            if old is not None and old[1] == page_stamp(dm):
+                if old[0] != position or old[2] != meta:
+                    pages.append((position, dm, meta, None))
+                continue
+            # Read before the transaction: an unloaded page may come from
+            # this very file
+            pages.append((position, dm, meta, page_columns(dm)))
+            if progress is not None:
+                progress(position + 1, len(dms))
+        names = {dm.page_name for dm in dms}
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for name in stored:
+                if name not in names:
+                    conn.execute("DELETE FROM pages WHERE name = ?", (name,))
+                    conn.execute("DELETE FROM columns WHERE page = ?", (name,))
+            for position, dm, meta, columns in pages:
+                if columns is None:
+                    conn.execute("UPDATE pages SET position = ?, meta = ? WHERE name = ?", (position, meta, dm.page_name))
+                    continue
+                conn.execute("DELETE FROM columns WHERE page = ?", (dm.page_name,))
+                conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", (position, dm.page_name, dm.row_count(), page_stamp(dm), meta))
+                conn.executemany("INSERT INTO columns VALUES (?, ?, ?, ?, ?, ?)", [
+                    (dm.page_name, j) + column for j, column in enumerate(columns)
+                ])
+            conn.executemany("INSERT OR REPLACE INTO session VALUES (?, ?)", [
+                ("format_version", str(FORMAT_VERSION)),
+                ("journal_seq", None if journal_seq is None else str(journal_seq)),
+                ("stale", "1" if stale else "0"),
+            ])
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+
+def load_session(path):
+    # Reads page settings only; each page's data is read on first use
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        info = dict(conn.execute("SELECT key, value FROM session"))
+        version = int(info.get("format_version", 0))
+        if version > FORMAT_VERSION:
+            raise ValueError(f"Session file was written by a newer version (format {version}).")
+        dms = []
+        stamp = "stamp" if version >= 2 else "NULL"
+        for name, rows, stamp, meta in conn.execute(f"SELECT name, rows, {stamp}, meta FROM pages ORDER BY position").fetchall():
+            meta = json.loads(meta)
+            dm = data_model.DataModel()
+            dm.page_name = name
+            if stamp is not None:
+                uid, data_version = stamp.rsplit(':', 1)
+                dm.uid, dm.data_version = uid, int(data_version)
+            dm.source = PageSource(path, name, rows, meta["columns"])
+            dm.next_row_id = rows
+            dm.column_types = dict(meta["types"])
+            dm.column_formulas = dict(meta["formulas"])
+            dm.column_formula_refs = {c: formula_engine.parse_refs(f) for c, f in dm.column_formulas.items()}
+            dm.column_tiers = {c: (mode, [tuple(t) for t in tiers]) for c, (mode, tiers) in meta["tiers"].items()}
+            dm.plot_columns = list(meta["plot_columns"])
+            dms.append(dm)
+    finally:
+        conn.close()
+    session = data_model.Session(dms)
+    if info.get("journal_seq") is not None:
+        session.journal_seq = int(info["journal_seq"])
+    session.needs_recompute = info.get("stale") == "1"
+    return session
+
+
+def open_session(path, legacy_path=None):
+    # Loads the session, converting an Excel session from older versions
+    # (and its unsaved journal) on first start; the Excel file is left as
+    # it was
+    if not os.path.exists(path) and legacy_path is not None and os.path.exists(legacy_path):
+        session = file_io.load_multi(legacy_path)
+        session[0].recompute_all_computed()
+        save_session(session, path, session.journal_seq)
+        if os.path.exists(legacy_path + ".journal") and not os.path.exists(path + ".journal"):
+            os.replace(legacy_path + ".journal", path + ".journal")
+    if not os.path.exists(path):
+        return data_model.Session([data_model.DataModel()])
+    return load_session(path)
@@ -8,6 +8,10 @@ def setup_shortcuts(window):
     window.undo_action.triggered.connect(window.undo)
     window.addAction(window.undo_action)
 
+    window.redo_action.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_Y))
+    window.redo_action.triggered.connect(window.redo)
+    window.addAction(window.redo_action)
+
     window.open_action.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_O))
     window.open_action.triggered.connect(window.import_data)
     window.addAction(window.open_action)
@@ -34,6 +38,8 @@ def setup_shortcuts(window):
 
     window.chart_view_action.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_B))
 
+    window.filter_action.setShortcut(QKeySequence(Qt.CTRL + Qt.ALT + Qt.Key_F))
+
     window.add_page_action.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_N))
 
     window.rename_page_action.setShortcut(QKeySequence(Qt.CTRL + Qt.SHIFT + Qt.Key_N))
@@ -14,14 +14,14 @@ class StyleHandler:
         family, ok = QInputDialog.getItem(self.main, "Change Font Family", "Select font family:", families, current_index, False)
         if ok:
             self.main.font_family = family
-            self.apply_styles()
+            self.main.apply_styles()
             self.main.update_chart()
 
     def change_font_size(self):
         size, ok = QInputDialog.getInt(self.main, "Change Font Size", "Enter new font size:", self.main.font_size, 6, 36, 1)
         if ok:
             self.main.font_size = size
-            self.apply_styles()
+            self.main.apply_styles()
             self.main.update_chart()
 
     def apply_styles(self):
@@ -32,9 +32,6 @@ class StyleHandler:
                 font-size: {self.main.font_size}px;
             }}
             QTableView {{
-               background-color: rgba(0, 0, 0, 128);
-            }}
-            QTableWidget {{
                 background-color: rgba(0, 0, 0, 128);
                 color: #FFF;
                 gridline-color: #3498db;
@@ -55,7 +52,7 @@ class StyleHandler:
             QHeaderView[orientation="vertical"]::section {{
                 border-bottom: 2px solid #FFFFFF;
             }}
-            QTableWidget::item:selected {{
+            QTableView::item:selected {{
                 background-color: #3498db;
             }}
             QTableCornerButton::section {{
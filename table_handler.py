@@ -1,155 +1,226 @@
 # table_handler.py
-from PyQt5.QtWidgets import QTableWidgetItem, QMessageBox
-from PyQt5.QtGui import QColor
-from PyQt5.QtCore import Qt
-import pandas as pd
+from PyQt5.QtWidgets import QApplication, QMessageBox
+from PyQt5.QtCore import Qt, QTimer
+from table_model import PageTableModel, CellDelegate
+from row_filter import RowFilter
+from column_widths import ColumnWidths
+
+
+class PageView:
+    # How a page's table looked when the user switched away from it
+    def __init__(self, model):
+        self.model = model
+        self.selection = None
+        self.widths = {}
+        self.scroll = (0, 0)
+        self.filter_text = ""
+        self.filter_error = ""
+
 
 class TableHandler:
     def __init__(self, main):
         self.main = main
-        self.main.table.itemChanged.connect(self.handle_cell_change)
-        self.main.table.horizontalHeader().sortIndicatorChanged.connect(self.on_sort_changed)
-        self.main.table.horizontalHeader().sectionResized.connect(self.on_section_resized)
-        self.main.table.itemClicked.connect(self.handle_item_clicked)
+        self.views = {}
+        self.view = None
+        self.model = None
         self.min_widths = []
+        self.widths = ColumnWidths(self.main.table)
+        self.main.table.setItemDelegate(CellDelegate(self.main.table))
+        self.main.table.horizontalHeader().sectionClicked.connect(self.on_header_clicked)
+        self.main.table.horizontalHeader().sectionResized.connect(self.on_section_resized)
+        self.main.filter_input.textChanged.connect(self.apply_filter)
+        self.show_page(self.main.data_model)
+
+    def on_header_clicked(self, col):
+        # Click sorts by the column (again to flip it); Shift+click adds it
+        # as a further key, e.g. score descending, then model name
+        name = self.model.header(col)
+        keys = list(self.model.sort_keys)
+        names = [key[0] for key in keys]
+        flipped = lambda i: Qt.DescendingOrder if keys[i][1] == Qt.AscendingOrder else Qt.AscendingOrder
+        if QApplication.keyboardModifiers() & Qt.ShiftModifier and keys:
+            if name in names:
+                i = names.index(name)
+                keys[i] = (name, flipped(i))
+            else:
+                keys.append((name, Qt.AscendingOrder))
+        elif names[:1] == [name]:
+            keys = [(name, flipped(0))]
+        else:
+            keys = [(name, Qt.AscendingOrder)]
+        self.set_sort_keys(keys)
+
+    def set_sort_keys(self, keys):
+        self.model.set_sort_keys(keys)
+        self.update_sort_indicator()
 
-    def on_sort_changed(self, col, order):
-        self.main.has_been_sorted = True
-        self.main.current_sort_col = col
-        self.main.current_sort_order = order
+    def update_sort_indicator(self):
+        header = self.main.table.horizontalHeader()
+        columns = self.main.data_model.df.columns
+        keys = [(name, order) for name, order in self.model.sort_keys if name in columns]
+        if keys:
+            header.setSortIndicator(columns.get_loc(keys[0][0]), keys[0][1])
+        else:
+            header.setSortIndicator(-1, Qt.AscendingOrder)
 
     def on_section_resized(self, col, old_size, new_size):
         if col < len(self.min_widths) and new_size < self.min_widths[col]:
             self.main.table.setColumnWidth(col, self.min_widths[col])
 
+    def on_columns_inserted(self, parent, first, last):
+        for j in range(first, last + 1):
+            self.min_widths.insert(j, self.column_width(j))
+            self.main.table.setColumnWidth(j, self.min_widths[j])
+        self.update_sort_indicator()
+
+    def on_columns_removed(self, parent, first, last):
+        del self.min_widths[first:last + 1]
+        self.update_sort_indicator()
+
+    def page_view(self, dm):
+        view = self.views.get(dm)
+        if view is None:
+            model = PageTableModel(dm, self.main.table)
+            model.set_page(dm)
+            model.edit_failed.connect(self.show_edit_error)
+            model.columnsInserted.connect(self.on_columns_inserted)
+            model.columnsRemoved.connect(self.on_columns_removed)
+            model.modelReset.connect(lambda: self.on_model_reset(model))
+            for signal in (model.rowsInserted, model.rowsRemoved, model.layoutChanged, model.modelReset):
+                signal.connect(self.update_filter_count)
+            view = self.views[dm] = PageView(model)
+        return view
+
+    def retain(self, session):
+        for dm in [dm for dm in self.views if dm not in session]:
+            view = self.views.pop(dm)
+            view.model.detach()
+            view.model.deleteLater()
+        self.widths.retain(session)
+
+    def save_view(self):
+        view, table = self.view, self.main.table
+        view.model.deactivate()
+        view.selection = table.selectionModel()
+        columns = view.model.dm.df.columns
+        view.widths = {columns[j]: table.columnWidth(j) for j in range(min(len(columns), view.model.columnCount()))}
+        view.scroll = (table.horizontalScrollBar().value(), table.verticalScrollBar().value())
+        view.filter_text = self.main.filter_input.text()
+        view.filter_error = self.main.filter_input.toolTip()
+
+    def show_page(self, dm):
+        # Every page keeps its own model with its sort, filter, selection,
+        # scroll position and column widths. Switching back to a page is a
+        # swap; only a page whose data changed meanwhile catches up.
+        table = self.main.table
+        session = dm.get_session()
+        if self.on_page_change not in session.listeners:
+            session.listeners.append(self.on_page_change)
+        if self.view is not None and self.view.model.dm is not dm:
+            self.save_view()
+        self.retain(session)
+        view = self.page_view(dm)
+        self.view, self.model = view, view.model
+        if table.model() is not view.model:
+            table.setModel(view.model)
+            if view.selection is not None:
+                created = table.selectionModel()
+                table.setSelectionModel(view.selection)
+                created.deleteLater()
+        view.model.activate()
+        self.widths.catch_up(dm)
+        self.apply_widths()
+        self.update_sort_indicator()
+        self.main.filter_input.blockSignals(True)
+        self.main.filter_input.setText(view.filter_text)
+        self.main.filter_input.blockSignals(False)
+        self.show_filter_error(view.filter_error)
+        self.update_filter_count()
+        QTimer.singleShot(0, lambda: self.restore_scroll(view))
+
+    def restore_scroll(self, view):
+        if view is self.view:
+            self.main.table.horizontalScrollBar().setValue(view.scroll[0])
+            self.main.table.verticalScrollBar().setValue(view.scroll[1])
+
+    def on_model_reset(self, model):
+        # A reset puts every section back to the default width
+        if model is self.model:
+            self.apply_widths()
+
     def update_table(self):
-        self.main.data_model.df = self.main.data_model.df.fillna('')
-        self.main.table.blockSignals(True)  # Prevent recursion
-        self.main.table.setRowCount(len(self.main.data_model.df))
-        self.main.table.setColumnCount(len(self.main.data_model.df.columns))
-        self.main.table.setHorizontalHeaderLabels(self.main.data_model.df.columns.tolist())
-        try:
-            model_col = self.main.data_model.df.columns.get_loc(self.main.data_model.model_col_name)
-        except KeyError:
-            model_col = -1  # Fallback, but assume present
-        for i, row in self.main.data_model.df.iterrows():
-            for j, val in enumerate(row):
-                header = self.main.data_model.df.columns[j]
-                typ = self.main.data_model.column_types.get(header)
-                if typ == "boolean":
-                    item = QTableWidgetItem()
-                    item.setFlags(Qt.ItemIsEnabled)
-                    item.setCheckState(Qt.Checked if val else Qt.Unchecked)
-                else:
-                    item = QTableWidgetItem(str(val) if pd.notna(val) else '')
-                    if typ in ["integer", "float"]:
-                        try:
-                            num_val = float(val) if pd.notna(val) else 0.0
-                            item.setData(Qt.UserRole, num_val)
-                        except ValueError:
-                            pass
-                bg_color = self.main.data_model.get_column_color(header, val)
-                if bg_color.alpha() > 0:
-                    bg_color.setAlpha(180)
-                item.setBackground(bg_color)
-                fg_color = QColor("black") if self.is_light_color(bg_color) else QColor("white")
-                item.setForeground(fg_color)
-                if j == model_col:
-                    item.setData(self.main.DF_ROW_ROLE, int(i))
-                self.main.table.setItem(i, j, item)
-        self.main.table.blockSignals(False)  # Re-enable signals
-        self.main.table.resizeColumnsToContents()
-        self.min_widths = [self.main.table.columnWidth(j) for j in range(self.main.table.columnCount())]
+        self.show_page(self.main.data_model)
+
+    def column_width(self, j):
+        header = self.main.table.horizontalHeader().sectionSizeHint(j)
+        return max(header, self.widths.content_width(self.main.data_model, self.model.header(j)))
+
+    def apply_widths(self, columns=None):
+        # Every column on a page switch or font change, keeping what the user
+        # widened; afterwards only the ones whose longest value changed, and
+        # those only ever widen
+        if columns is None:
+            self.min_widths = [self.column_width(j) for j in range(self.model.columnCount())]
+            for j, width in enumerate(self.min_widths):
+                self.main.table.setColumnWidth(j, max(width, self.view.widths.get(self.model.header(j), 0)))
+            return
+        for col in columns:
+            if col not in self.main.data_model.df.columns:
+                continue
+            j = self.main.data_model.df.columns.get_loc(col)
+            self.min_widths[j] = self.column_width(j)
+            if self.main.table.columnWidth(j) < self.min_widths[j]:
+                self.main.table.setColumnWidth(j, self.min_widths[j])
+
+    def on_page_change(self, dm, change, *args):
+        # The model repaints the changed cells of the shown page; other pages
+        # (e.g. cross-page formula results) are only marked stale
+        if dm is not self.model.dm:
+            self.widths.mark_stale(dm, change, *args)
+            return
+        columns = self.widths.on_change(dm, change, *args)
+        if columns != set():
+            self.apply_widths(columns)
+
+    def on_font_changed(self):
+        self.widths.clear()
+        self.apply_widths()
 
     def refresh_table(self):
         self.update_table()
-        if self.main.has_been_sorted:
-            self.main.table.sortItems(self.main.current_sort_col, self.main.current_sort_order)
-
-    def handle_cell_change(self, item):
-        visual_row = item.row()
-        col = item.column()
-        header = self.main.data_model.df.columns[col]
-        typ = self.main.data_model.column_types.get(header)
-        if typ == "boolean":
-            return  # Handled separately
-        model_col = self.main.data_model.df.columns.get_loc(self.main.data_model.model_col_name)
-        model_item = self.main.table.item(visual_row, model_col)
-        if model_item:
-            df_row = model_item.data(self.main.DF_ROW_ROLE)
-            if df_row is not None:
-                val = item.text()
-                try:
-                    self.main.data_model.update_cell(df_row, header, val)
-                    # Update all potentially affected cells in this row (since recompute_all_computed may change other columns)
-                    for k in range(self.main.table.columnCount()):
-                        h = self.main.table.horizontalHeaderItem(k).text()
-                        it = self.main.table.item(visual_row, k)
-                        if it:
-                            new_v = self.main.data_model.df.at[df_row, h]
-                            it.setText(str(new_v))
-                            if self.main.data_model.column_types.get(h) in ["integer", "float"]:
-                                try:
-                                    num_v = float(new_v)
-                                    it.setData(Qt.UserRole, num_v)
-                                except ValueError:
-                                    pass
-                            bg = self.main.data_model.get_column_color(h, new_v)
-                            if bg.alpha() > 0:
-                                bg.setAlpha(180)
-                            it.setBackground(bg)
-                            fg = QColor("black") if self.is_light_color(bg) else QColor("white")
-                            it.setForeground(fg)
-                except ValueError as e:
-                    QMessageBox.warning(self.main, "Invalid Input", str(e))
-                    # Revert text
-                    item.setText(str(self.main.data_model.df.at[df_row, header]))
-
-    def handle_item_clicked(self, item):
-        col = item.column()
-        header = self.main.data_model.df.columns[col]
-        if self.main.data_model.column_types.get(header) == "boolean":
-            current_state = item.checkState()
-            new_state = Qt.Unchecked if current_state == Qt.Checked else Qt.Checked
-            item.setCheckState(new_state)
-            model_col = self.main.data_model.df.columns.get_loc(self.main.data_model.model_col_name)
-            df_row = self.main.table.item(item.row(), model_col).data(self.main.DF_ROW_ROLE)
-            val = (new_state == Qt.Checked)
-            self.main.data_model.update_cell(df_row, header, val)
-            # Update color
-            bg_color = self.main.data_model.get_column_color(header, val)
-            if bg_color.alpha() > 0:
-                bg_color.setAlpha(180)
-            item.setBackground(bg_color)
-            fg_color = QColor("black") if self.is_light_color(bg_color) else QColor("white")
-            item.setForeground(fg_color)
-
-            # Update affected cells in row
-            visual_row = item.row()
-            for k in range(self.main.table.columnCount()):
-                h = self.main.table.horizontalHeaderItem(k).text()
-                if h == header:
-                    continue
-                it = self.main.table.item(visual_row, k)
-                if it and h in self.main.data_model.column_formulas:
-                    new_v = self.main.data_model.df.at[df_row, h]
-                    it.setText(str(new_v))
-                    if self.main.data_model.column_types.get(h) in ["integer", "float"]:
-                        try:
-                            num_v = float(new_v)
-                            it.setData(Qt.UserRole, num_v)
-                        except ValueError:
-                            pass
-                    bg = self.main.data_model.get_column_color(h, new_v)
-                    if bg.alpha() > 0:
-                        bg.setAlpha(180)
-                    it.setBackground(bg)
-                    fg = QColor("black") if self.is_light_color(bg) else QColor("white")
-                    it.setForeground(fg)
-
-    def is_light_color(self, color):
-        r = color.red() / 255.0
-        g = color.green() / 255.0
-        b = color.blue() / 255.0
-        luminance = 0.299 * r + 0.587 * g + 0.114 * b
-        return luminance > 0.5
\ No newline at end of file
+
+    def apply_filter(self, text):
+        # Runs on every keystroke; text that doesn't parse or fit the page
+        # keeps the last good filter and marks the bar
+        try:
+            row_filter = RowFilter(text)
+            self.model.set_filter(None if row_filter.is_empty() else row_filter)
+        except ValueError as e:
+            self.model.rearrange()
+            self.show_filter_error(str(e))
+            return
+        self.show_filter_error("")
+
+    def show_filter_error(self, message):
+        self.main.filter_input.setStyleSheet("border: 1px solid #e74c3c;" if message else "")
+        self.main.filter_input.setToolTip(message)
+
+    def update_filter_count(self, *args):
+        if self.model.row_filter is None:
+            self.main.filter_count.setText("")
+        else:
+            self.main.filter_count.setText(f"{self.model.rowCount()} of {len(self.model.dm.df)}")
+
+    def show_edit_error(self, message):
+        QMessageBox.warning(self.main, "Invalid Input", message)
+
+    def selected_rows(self):
+        rows = set()
+        for r in self.main.table.selectionModel().selection():
+            rows.update(range(r.top(), r.bottom() + 1))
+        return sorted(rows)
+
+    def remove_rows(self, rows):
+        # The page's notification takes the rows out of the table
+        dm = self.main.data_model
+        dm.remove_rows(dm.df.index[self.model.positions(rows)])
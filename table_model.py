@@ -0,0 +1,447 @@
+# table_model.py
+import numpy as np
+import pandas as pd
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QEvent, pyqtSignal
+from PyQt5.QtWidgets import QStyledItemDelegate
+import tiers
+from row_filter import NameIndex
+
+ROW_ID_ROLE = Qt.UserRole + 1
+
+# Up to this many changed cells are reported one by one, which makes the
+# view repaint just those; more are reported as one range
+REPAINT_CELLS = 64
+
+
+class PageTableModel(QAbstractTableModel):
+    # Serves one page straight from its DataFrame; nothing is materialized
+    # per cell, values and tier colors are looked up when Qt asks for them.
+    # order maps view rows to DataFrame positions (None while showing every
+    # row unsorted); a row_filter leaves the rows it hides out of order.
+    # sort_keys lists (column name, order) pairs, the first one primary.
+    # The page's change notifications are turned into the matching Qt
+    # signals, so the view keeps its scroll position, selection and sort.
+    edit_failed = pyqtSignal(str)
+
+    def __init__(self, dm, parent=None):
+        super().__init__(parent)
+        self.dm = dm
+        self.order = None
+        self.tier_rows = {}
+        self.sort_keys = []
+        self.sort_ranks = {}
+        self.row_filter = None
+        self.name_index = None
+        self.active = True
+        self.version = None
+
+    def set_page(self, dm):
+        self.beginResetModel()
+        self.dm = dm
+        self.order = None
+        self.tier_rows = {}
+        self.sort_ranks = {}
+        self.name_index = None
+        self.version = dm.version
+        self.endResetModel()
+        session = dm.get_session()
+        if self.on_change not in session.listeners:
+            session.listeners.append(self.on_change)
+
+    def detach(self):
+        listeners = self.dm.get_session().listeners
+        if self.on_change in listeners:
+            listeners.remove(self.on_change)
+
+    def activate(self):
+        # A page hidden while its data changed is brought up to date in one go
+        self.active = True
+        if self.version != self.dm.version:
+            self.on_reset()
+
+    def deactivate(self):
+        self.active = False
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.dm.df) if self.order is None else len(self.order)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.dm.df.columns)
+
+    def position(self, row):
+        return row if self.order is None else int(self.order[row])
+
+    def positions(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        return rows if self.order is None else self.order[rows]
+
+    def row_id(self, row):
+        return self.dm.df.index[self.position(row)]
+
+    def header(self, col):
+        return self.dm.df.columns[col]
+
+    def is_boolean(self, col):
+        return self.dm.column_types.get(self.header(col)) == "boolean"
+
+    def tier_style(self, pos, col):
+        header = self.header(col)
+        compiled = self.dm.tier_classifier(header)
+        if compiled is None:
+            return tiers.NO_TIER
+        cached = self.tier_rows.get(col)
+        if cached is None or cached[0] is not compiled:
+            cached = (compiled, compiled.classify(self.dm.df[header]))
+            self.tier_rows[col] = cached
+        return compiled.style(cached[1][pos])
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        pos, col = self.position(index.row()), index.column()
+        if pos < 0:
+            return None
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            if self.is_boolean(col):
+                return None
+            val = self.dm.df.iat[pos, col]
+            return str(val) if pd.notna(val) else ''
+        if role == Qt.CheckStateRole:
+            if not self.is_boolean(col):
+                return None
+            val = self.dm.df.iat[pos, col]
+            return Qt.Checked if pd.notna(val) and val else Qt.Unchecked
+        if role == Qt.BackgroundRole:
+            return self.tier_style(pos, col).background
+        if role == Qt.ForegroundRole:
+            return self.tier_style(pos, col).foreground
+        if role == ROW_ID_ROLE:
+            return int(self.dm.df.index[pos])
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.ToolTipRole and orientation == Qt.Horizontal:
+            return self.sort_tooltip(section)
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.header(section) if section < len(self.dm.df.columns) else None
+        return str(section + 1)
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if self.is_boolean(index.column()):
+            return Qt.ItemIsEnabled
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid():
+            return False
+        if role == Qt.CheckStateRole:
+            value = value == Qt.Checked
+        elif role != Qt.EditRole:
+            return False
+        try:
+            self.dm.update_cell(self.row_id(index.row()), self.header(index.column()), value)
+        except ValueError as e:
+            self.edit_failed.emit(str(e))
+            return False
+        return True
+
+    def view_rows(self, positions):
+        # -1 for rows that aren't shown
+        if self.order is None:
+            return positions
+        inverse = np.full(len(self.dm.df), -1, dtype=np.int64)
+        inverse[self.order] = np.arange(len(self.order))
+        return inverse[positions]
+
+    def on_change(self, dm, change, *args):
+        # Hidden pages don't follow their changes, activate() catches up
+        if dm is self.dm and self.active:
+            getattr(self, "on_" + change)(*args)
+            self.version = dm.version
+
+    def on_cells(self, col, rows):
+        if col not in self.dm.df.columns:
+            return
+        j = self.dm.df.columns.get_loc(col)
+        cached = self.tier_rows.get(j)
+        if cached is not None and rows is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+            cached[1][rows] = cached[0].classify(self.dm.df[col].iloc[rows])
+        else:
+            self.tier_rows.pop(j, None)
+        self.sort_ranks.pop(col, None)
+        if col == self.dm.model_col_name:
+            self.update_name_index(rows)
+        if self.row_filter is not None and col in self.row_filter.columns(self.dm):
+            self.rearrange()
+            return
+        if col in self.sort_columns():
+            if rows is None or len(rows) != 1:
+                self.rearrange()
+                return
+            # A single edit only moves its own row
+            top = bottom = self.move_row(int(rows[0]))
+            if top is None:
+                return
+        elif rows is None:
+            if not self.rowCount():
+                return
+            top, bottom = 0, self.rowCount() - 1
+        else:
+            view = self.view_rows(np.asarray(rows, dtype=np.int64))
+            view = view[view >= 0]
+            if not len(view):
+                return
+            if len(view) <= REPAINT_CELLS:
+                for row in view.tolist():
+                    self.dataChanged.emit(self.index(row, j), self.index(row, j))
+                return
+            top, bottom = int(view.min()), int(view.max())
+        self.dataChanged.emit(self.index(top, j), self.index(bottom, j))
+
+    def on_rows_inserted(self, positions):
+        # The page already holds the new rows at these DataFrame positions
+        positions = np.unique(np.asarray(positions, dtype=np.int64))
+        self.tier_rows = {}
+        self.sort_ranks = {}
+        total = len(self.dm.df)
+        old = np.arange(total - len(positions)) if self.order is None else self.order
+        in_place = self.order is None and not self.sort_columns() and self.row_filter is None
+        self.order = np.delete(np.arange(total), positions)[old]
+        self.update_name_index(positions)
+        if not in_place:
+            # Add the shown ones at the end, then put everything back in order
+            mask = self.filter_mask()
+            if mask is not None:
+                positions = positions[mask[positions]]
+            if len(positions):
+                self.beginInsertRows(QModelIndex(), len(self.order), len(self.order) + len(positions) - 1)
+                self.order = np.concatenate([self.order, positions])
+                self.endInsertRows()
+            self.rearrange()
+            return
+        runs = np.split(positions, np.flatnonzero(np.diff(positions) != 1) + 1)
+        for run in runs:
+            if len(run):
+                self.beginInsertRows(QModelIndex(), int(run[0]), int(run[-1]))
+                self.order = np.insert(self.order, int(run[0]), run)
+                self.endInsertRows()
+        self.order = None
+
+    def on_rows_removed(self, positions):
+        # The page already dropped the rows at these DataFrame positions
+        positions = np.unique(np.asarray(positions, dtype=np.int64))
+        self.tier_rows = {}
+        # Dropping rows keeps the relative rank of the remaining ones
+        self.sort_ranks = {name: np.delete(ranks, positions) for name, ranks in self.sort_ranks.items()}
+        order = np.arange(len(self.dm.df) + len(positions)) if self.order is None else self.order
+        removed = np.isin(order, positions)
+        view_rows = np.flatnonzero(removed)
+        # Rows after a removed one move up by one position per removal; the
+        # removed ones have no data left to show while they are taken out
+        self.order = np.where(removed, -1, order - np.searchsorted(positions, order))
+        runs = np.split(view_rows, np.flatnonzero(np.diff(view_rows) != 1) + 1)
+        for run in reversed(runs):
+            if len(run):
+                self.beginRemoveRows(QModelIndex(), int(run[0]), int(run[-1]))
+                self.order = np.delete(self.order, run)
+                self.endRemoveRows()
+        if self.name_index is not None:
+            self.name_index.retain(self.dm.df.index)
+        if len(self.order) == len(self.dm.df) and np.array_equal(self.order, np.arange(len(self.order))):
+            self.order = None
+
+    def on_column_inserted(self, col):
+        j = self.dm.df.columns.get_loc(col)
+        self.beginInsertColumns(QModelIndex(), j, j)
+        self.tier_rows = {}
+        self.sort_ranks.pop(col, None)
+        self.endInsertColumns()
+
+    def on_column_removed(self, j):
+        self.beginRemoveColumns(QModelIndex(), j, j)
+        self.tier_rows = {}
+        self.sort_ranks = {name: ranks for name, ranks in self.sort_ranks.items() if name in self.dm.df.columns}
+        self.endRemoveColumns()
+
+    def on_column_renamed(self, old_name, new_name):
+        self.sort_keys = [(new_name if name == old_name else name, order) for name, order in self.sort_keys]
+        if old_name in self.sort_ranks:
+            self.sort_ranks[new_name] = self.sort_ranks.pop(old_name)
+        self.headerDataChanged.emit(Qt.Horizontal, 0, self.columnCount() - 1)
+
+    def on_meta(self):
+        # Types or tiers changed: repaint everything, nothing moves
+        self.sort_ranks = {}
+        if self.rowCount() and self.columnCount():
+            self.dataChanged.emit(self.index(0, 0), self.index(self.rowCount() - 1, self.columnCount() - 1))
+        self.headerDataChanged.emit(Qt.Horizontal, 0, self.columnCount() - 1)
+
+    def on_reset(self):
+        self.set_page(self.dm)
+        self.rearrange()
+
+    def rearrange(self):
+        if self.sort_columns() or self.row_filter is not None or self.order is not None:
+            self.apply_order(self.arranged())
+
+    def arranged(self, strict=False):
+        # The rows to show, in display order
+        order = self.sorted_order() if self.sort_columns() else None
+        mask = self.filter_mask(strict)
+        if mask is not None:
+            order = np.flatnonzero(mask) if order is None else order[mask[order]]
+        return order
+
+    def filter_mask(self, strict=False):
+        if self.row_filter is None:
+            return None
+        if self.row_filter.words and self.name_index is None:
+            self.name_index = NameIndex(self.dm.df[self.dm.model_col_name])
+        return self.row_filter.mask(self.dm, self.name_index, strict)
+
+    def update_name_index(self, positions):
+        if self.name_index is None:
+            return
+        if positions is None:
+            self.name_index = None
+            return
+        names = self.dm.df[self.dm.model_col_name]
+        for pos in positions:
+            self.name_index.add(self.dm.df.index[pos], names.iat[pos])
+
+    def set_filter(self, row_filter):
+        # A filter that doesn't fit the page raises before anything changes
+        previous, self.row_filter = self.row_filter, row_filter
+        try:
+            order = self.arranged(strict=True)
+        except ValueError:
+            self.row_filter = previous
+            raise
+        self.apply_order(order)
+
+    def sort_columns(self):
+        return [name for name, order in self.sort_keys if name in self.dm.df.columns]
+
+    def is_numeric(self, name):
+        return self.dm.column_types.get(name) in ("integer", "float", "boolean")
+
+    def sort_rank(self, name):
+        # Dense rank of each row's value (-1 when missing), kept until the
+        # column changes so re-sorting never compares values again
+        ranks = self.sort_ranks.get(name)
+        if ranks is None:
+            series = self.dm.df[name]
+            if self.is_numeric(name):
+                series = series.to_numpy(dtype=float, na_value=np.nan)
+            ranks = pd.factorize(series, sort=True)[0]
+            self.sort_ranks[name] = ranks
+        return ranks
+
+    def sorted_order(self):
+        keys = []
+        for name, order in self.sort_keys:
+            if name not in self.dm.df.columns:
+                continue
+            ranks = self.sort_rank(name)
+            missing = ranks < 0
+            if order == Qt.DescendingOrder:
+                ranks = ranks.max(initial=0) - ranks
+            # Missing values go last either way
+            keys.append(np.where(missing, len(ranks), ranks))
+        # lexsort is stable and takes its primary key last
+        return np.lexsort(keys[::-1])
+
+    def sort_value(self, name, pos):
+        val = self.dm.df[name].iat[pos]
+        if pd.isna(val):
+            return None
+        return float(val) if self.is_numeric(name) else val
+
+    def sorts_before(self, a, b):
+        for name, order in self.sort_keys:
+            if name not in self.dm.df.columns:
+                continue
+            va, vb = self.sort_value(name, a), self.sort_value(name, b)
+            if va is None or vb is None:
+                if (va is None) != (vb is None):
+                    return vb is None
+            elif va != vb:
+                return (va < vb) == (order == Qt.AscendingOrder)
+        return a < b
+
+    def move_row(self, pos):
+        # The other rows are still in order: binary search the new place of
+        # this one and move it alone. Returns its view row, None if hidden.
+        order = np.arange(len(self.dm.df)) if self.order is None else self.order
+        found = np.flatnonzero(order == pos)
+        if not len(found):
+            return None
+        row = int(found[0])
+        others = np.delete(order, row)
+        lo, hi = 0, len(others)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sorts_before(int(others[mid]), pos):
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == row:
+            return row
+        self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), lo + 1 if lo > row else lo)
+        self.order = np.insert(others, lo, pos)
+        self.endMoveRows()
+        return lo
+
+    def sort(self, col, order=Qt.AscendingOrder):
+        if 0 <= col < self.columnCount():
+            self.set_sort_keys([(self.header(col), order)])
+
+    def set_sort_keys(self, keys):
+        self.sort_keys = list(keys)
+        self.rearrange()
+        self.headerDataChanged.emit(Qt.Horizontal, 0, self.columnCount() - 1)
+
+    def sort_tooltip(self, col):
+        names = [name for name, order in self.sort_keys]
+        if len(names) < 2 or self.header(col) not in names:
+            return None
+        i = names.index(self.header(col))
+        direction = "ascending" if self.sort_keys[i][1] == Qt.AscendingOrder else "descending"
+        return f"Sort key {i + 1} ({direction})"
+
+    def apply_order(self, order):
+        self.layoutAboutToBeChanged.emit()
+        old = self.order
+        self.order = order
+        # Keep selection and current cell on the same DataFrame rows; rows
+        # that are no longer shown drop out of them
+        view_rows = np.full(len(self.dm.df), -1, dtype=np.int64)
+        shown = np.arange(len(self.dm.df)) if order is None else order
+        view_rows[shown] = np.arange(len(shown))
+        persistent = self.persistentIndexList()
+        moved = []
+        for index in persistent:
+            pos = index.row() if old is None else int(old[index.row()])
+            row = int(view_rows[pos])
+            moved.append(self.index(row, index.column()) if row >= 0 else QModelIndex())
+        self.changePersistentIndexList(persistent, moved)
+        self.layoutChanged.emit()
+
+
+class CellDelegate(QStyledItemDelegate):
+    # Booleans toggle on click instead of opening an editor
+    def editorEvent(self, event, model, option, index):
+        if index.data(Qt.CheckStateRole) is None:
+            return super().editorEvent(event, model, option, index)
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            state = Qt.Unchecked if index.data(Qt.CheckStateRole) == Qt.Checked else Qt.Checked
+            model.setData(index, state, Qt.CheckStateRole)
+            return True
+        return event.type() in (QEvent.MouseButtonPress, QEvent.MouseButtonDblClick)
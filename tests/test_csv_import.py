@@ -0,0 +1,33 @@
+# test_csv_import.py
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import csv_import
+
+
+def read(tmp_path, monkeypatch, text):
+    monkeypatch.setattr(csv_import, "SAMPLE_ROWS", 2)
+    monkeypatch.setattr(csv_import, "CHUNK_ROWS", 2)
+    path = tmp_path / "in.csv"
+    path.write_text(text)
+    reader = csv_import.CsvImport(str(path))
+    return reader, reader.read()
+
+
+def test_value_past_the_sample_widens_the_column(tmp_path, monkeypatch):
+    reader, df = read(tmp_path, monkeypatch, "Model,i,f,b\na,1,1.5,True\nb,,2.0,False\nc,3,oops,True\nd,x7,4.25,maybe\ne,5,6,False\n")
+    assert reader.widened == ["i", "f", "b"]
+    assert str(df["i"].dtype) == "string"
+    assert df["i"].tolist()[2:] == ["3", "x7", "5"]
+    assert df["i"].isna().tolist() == [False, True, False, False, False]
+    assert df["i"].iloc[0] == "1"
+    assert df["f"].tolist() == ["1.5", "2.0", "oops", "4.25", "6"]
+    assert df["b"].tolist() == ["True", "False", "True", "maybe", "False"]
+
+
+def test_fraction_past_the_sample_turns_integers_float(tmp_path, monkeypatch):
+    reader, df = read(tmp_path, monkeypatch, "Model,i\na,1\nb,2\nc,3.5\n")
+    assert reader.widened == []
+    assert str(df["i"].dtype) == "Float64"
+    assert df["i"].tolist() == [1.0, 2.0, 3.5]
@@ -0,0 +1,60 @@
+# test_data_model.py
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+import pytest
+import data_model
+
+
+def test_shallow_snapshot_is_isolated_from_edits():
+    dm = data_model.DataModel()
+    data_model.Session([dm])
+    dm.add_column("Score", "integer")
+    dm.add_column("Ratio", "float")
+    dm.bulk_add_models(["a", "b", "c"])
+    snap = dm.snapshot(deep=False)
+    before = snap.df.copy()
+    ids = dm.row_ids()
+    dm.update_cell(ids[0], "Score", "7")
+    dm.update_cell(ids[1], "Model", "z")
+    dm.bulk_update([(ids[2], "Ratio", "0.5")])
+    dm.set_column("Score", pd.array([1, 2, 3], dtype="Int64"))
+    dm.remove_rows([ids[0]])
+    dm.add_model("d")
+    pd.testing.assert_frame_equal(snap.df, before)
+
+
+def test_cross_page_formula_follows_model_names():
+    a = data_model.DataModel()
+    a.page_name = "A"
+    b = data_model.DataModel()
+    b.page_name = "B"
+    data_model.Session([a, b])
+    a.add_column("x", "float")
+    b.add_column("v", "integer")
+    a.bulk_add_models(["m1", "m2", "m3"])
+    b.bulk_add_models(["m3", "m1"])
+    b.bulk_update([(b.row_ids()[0], "v", "3"), (b.row_ids()[1], "v", "1")])
+    a.set_column_formula("x", "{B:v}*2")
+    assert a.df["x"].tolist() == [2.0, 0.0, 6.0]
+    # Only the matching row on A is recomputed
+    b.update_cell(b.row_ids()[0], "v", "4")
+    assert a.df["x"].tolist() == [2.0, 0.0, 8.0]
+
+
+def test_integer_out_of_range_is_rejected():
+    dm = data_model.DataModel()
+    data_model.Session([dm])
+    dm.add_column("Score", "integer")
+    dm.add_model("a")
+    row_id = dm.row_ids()[0]
+    for val in ["99999999999999999999", "-9223372036854775809"]:
+        with pytest.raises(ValueError):
+            dm.update_cell(row_id, "Score", val)
+        with pytest.raises(ValueError):
+            dm.bulk_update([(row_id, "Score", val)])
+    assert dm.df["Score"].tolist() == [0]
+    dm.update_cell(row_id, "Score", "9223372036854775807")
+    assert dm.df["Score"].tolist() == [2 ** 63 - 1]
@@ -0,0 +1,43 @@
+# test_journal.py
+import os
+import sys
+import threading
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_model
+import session_store
+from journal import Journal
+
+
+def test_compaction_writes_the_snapshot_not_later_edits(tmp_path, monkeypatch):
+    path = str(tmp_path / "session.db")
+    dm = data_model.DataModel()
+    session = data_model.Session([dm])
+    dm.add_column("Score", "integer")
+    dm.bulk_add_models(["a", "b"])
+    journal = Journal(path)
+    journal.attach(session)
+
+    # Hold the writer until the page has been edited behind its back
+    started, release = threading.Event(), threading.Event()
+    save_session = session_store.save_session
+
+    def blocked_save(*args, **kwargs):
+        started.set()
+        release.wait(5)
+        save_session(*args, **kwargs)
+
+    monkeypatch.setattr(session_store, "save_session", blocked_save)
+    journal.compact(session)
+    assert started.wait(5)
+    ids = dm.row_ids()
+    dm.update_cell(ids[0], "Score", "5")
+    dm.remove_rows([ids[1]])
+    release.set()
+    journal.wait()
+    assert journal.error is None
+
+    saved = session_store.load_session(path)[0]
+    assert saved.df["Model"].tolist() == ["a", "b"]
+    assert saved.df["Score"].tolist() == [0, 0]
+    journal.close()
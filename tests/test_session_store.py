@@ -0,0 +1,58 @@
+# test_session_store.py
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_model
+import session_store
+from journal import Journal
+
+
+def make_session(path):
+    dm = data_model.DataModel()
+    session = data_model.Session([dm])
+    dm.add_column("Score", "integer")
+    dm.bulk_add_models(["a", "b", "c"])
+    dm.bulk_update([(row_id, "Score", str(i)) for i, row_id in enumerate(dm.df.index)])
+    session_store.save_session(session, path)
+    return session
+
+
+def test_remove_rows_on_reloaded_page(tmp_path):
+    path = str(tmp_path / "session.db")
+    make_session(path)
+    dm = session_store.load_session(path)[0]
+    assert dm.source is not None and dm.model_index is None
+    dm.remove_rows([dm.row_ids()[1]])
+    assert dm.df["Model"].tolist() == ["a", "c"]
+    assert dm.df["Score"].tolist() == [0, 2]
+    assert not dm.has_model("b")
+    assert dm.has_model("c")
+
+
+def test_update_model_name_on_reloaded_page(tmp_path):
+    path = str(tmp_path / "session.db")
+    make_session(path)
+    dm = session_store.load_session(path)[0]
+    dm.update_cell(dm.row_ids()[0], "Model", "z")
+    assert dm.has_model("z")
+    assert not dm.has_model("a")
+
+
+def test_replay_remove_rows_on_lazy_page(tmp_path):
+    path = str(tmp_path / "session.db")
+    make_session(path)
+    session = session_store.load_session(path)
+    journal = Journal(path)
+    journal.attach(session)
+    dm = session[0]
+    dm.remove_rows([dm.row_ids()[0]])
+    # Leave the journal behind as a crash would
+    journal.file.close()
+
+    session = session_store.load_session(path)
+    assert session[0].source is not None
+    journal = Journal(path)
+    assert journal.replay(session) == 1
+    assert journal.skipped == []
+    assert session[0].df["Model"].tolist() == ["b", "c"]
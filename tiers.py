@@ -0,0 +1,94 @@
+# tiers.py
+import numpy as np
+import pandas as pd
+from PyQt5.QtGui import QColor, QBrush
+
+TABLE_ALPHA = 180
+
+
+def is_light_color(color):
+    luminance = 0.299 * color.redF() + 0.587 * color.greenF() + 0.114 * color.blueF()
+    return luminance > 0.5
+
+
+class TierStyle:
+    # Everything needed to paint one tier, built once per tier
+    def __init__(self, color_name):
+        self.color = QColor(color_name)
+        self.name = self.color.name()
+        table_color = QColor(self.color)
+        if table_color.alpha() > 0:
+            table_color.setAlpha(TABLE_ALPHA)
+        self.table_color = table_color
+        self.background = QBrush(table_color)
+        self.foreground = QBrush(QColor("black") if is_light_color(table_color) else QColor("white"))
+
+
+NO_TIER = TierStyle("transparent")
+
+
+class CompiledTiers:
+    # A column's tier config turned into lookup tables. classify() maps a
+    # whole column to tier indices (-1 for no tier) with the same
+    # first-matching-tier rule as walking the list
+    def __init__(self, config):
+        self.config = config
+        self.mode, tiers = config
+        tiers = list(tiers)
+        self.styles = [TierStyle(t[-1]) for t in tiers]
+        if self.mode == "string":
+            self.lookup = {}
+            for i, t in enumerate(tiers):
+                self.lookup.setdefault(str(t[0]), i)
+        elif self.mode == "min_threshold":
+            # Only a tier whose minimum is below every earlier one can ever
+            # be first to match; those form a descending run
+            reachable = []
+            for i, t in enumerate(tiers):
+                if not reachable or t[0] < tiers[reachable[-1]][0]:
+                    reachable.append(i)
+            self.indices = np.array(reachable[::-1], dtype=np.int64)
+            self.bounds = np.array([tiers[i][0] for i in reachable[::-1]], dtype=float)
+        elif self.mode == "range":
+            self.mins = np.array([t[0] for t in tiers], dtype=float)
+            self.maxs = np.array([t[1] for t in tiers], dtype=float)
+            # Sorted, disjoint ranges can be found with one searchsorted
+            self.disjoint = bool(np.all(np.diff(self.mins) > 0) and np.all(self.maxs[:-1] < self.mins[1:]))
+
+    def classify(self, series):
+        result = np.full(len(series), -1, dtype=np.int64)
+        if not self.styles or not len(series):
+            return result
+        if self.mode == "string":
+            present = series.notna().to_numpy()
+            text = series[present].astype(str)
+            result[present] = text.map(self.lookup).fillna(-1).to_numpy(dtype=np.int64)
+            return result
+        values = numeric(series)
+        if self.mode == "min_threshold":
+            pos = np.searchsorted(self.bounds, values, side='right') - 1
+            hit = (pos >= 0) & ~np.isnan(values)
+            result[hit] = self.indices[pos[hit]]
+        elif self.mode == "range":
+            if self.disjoint:
+                pos = np.searchsorted(self.mins, values, side='right') - 1
+                hit = pos >= 0
+                hit[hit] &= values[hit] <= self.maxs[pos[hit]]
+                result[hit] = pos[hit]
+            else:
+                for i in range(len(self.styles) - 1, -1, -1):
+                    result[(values >= self.mins[i]) & (values <= self.maxs[i])] = i
+        return result
+
+    def style(self, index):
+        return self.styles[index] if index >= 0 else NO_TIER
+
+    def styles_for(self, series):
+        return [self.styles[i] if i >= 0 else NO_TIER for i in self.classify(series)]
+
+
+def numeric(series):
+    # Float values for threshold comparisons; missing or non-numeric -> NaN
+    if pd.api.types.is_bool_dtype(series.dtype) or pd.api.types.is_numeric_dtype(series.dtype):
+        return series.to_numpy(dtype=float, na_value=np.nan)
+    return pd.to_numeric(series.astype(object), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
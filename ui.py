@@ -6,8 +6,8 @@ import matplotlib.pyplot as plt
 matplotlib.use('Qt5Agg')
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from PyQt5.QtWidgets import (
-    QWidget, QVBoxLayout, QHBoxLayout, QTableWidget,
-    QPushButton, QLabel, QLineEdit, QComboBox, QHeaderView, QAction, QMenuBar
+    QWidget, QVBoxLayout, QHBoxLayout, QTableView,
+    QPushButton, QLabel, QLineEdit, QComboBox, QHeaderView, QAction, QMenuBar, QProgressBar
 )
 from PyQt5.QtGui import QKeySequence, QFont, QFontDatabase, QPainter, QColor, QIcon
 from PyQt5.QtCore import Qt, QTimer, QPointF
@@ -95,10 +95,22 @@ class Ui_LeaderboardPro(object):
         self.top_controls.addStretch()
         self.left_layout.addLayout(self.top_controls)
 
-        self.table = QTableWidget()
+        # Filter bar above the table
+        self.filter_controls = QHBoxLayout()
+        self.filter_input = QLineEdit()
+        self.filter_input.setPlaceholderText("Filter models, e.g. ^gpt score>=50 passed=true")
+        self.filter_input.setClearButtonEnabled(True)
+        self.filter_controls.addWidget(self.filter_input)
+        self.filter_count = QLabel()
+        self.filter_controls.addWidget(self.filter_count)
+        self.left_layout.addLayout(self.filter_controls)
+
+        self.table = QTableView()
         self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
         self.table.verticalHeader().setSectionResizeMode(QHeaderView.Interactive)
-        self.table.setSortingEnabled(True)
+        # Sorting is driven by TableHandler so Shift+click can add sort keys
+        self.table.horizontalHeader().setSectionsClickable(True)
+        self.table.horizontalHeader().setSortIndicatorShown(True)
         self.left_layout.addWidget(self.table)
 
         self.figure, self.ax = plt.subplots(figsize=(9, 5))
@@ -137,4 +149,20 @@ class Ui_LeaderboardPro(object):
         self.font_size_action = QAction("Change Font Size")
         self.customize_menu.addAction(self.font_size_action)
         self.font_family_action = QAction("Change Font Family")
-        self.customize_menu.addAction(self.font_family_action)
\ No newline at end of file
+        self.customize_menu.addAction(self.font_family_action)
+        self.undo_memory_action = QAction("Change Undo Memory Limit")
+        self.customize_menu.addAction(self.undo_memory_action)
+
+        # Shown while computed columns are recomputed in the background
+        self.recompute_progress = QProgressBar()
+        self.recompute_progress.setFormat("Recomputing %v of %m columns")
+        self.recompute_progress.setMaximumWidth(300)
+        self.recompute_progress.hide()
+        LeaderboardPro.statusBar().addPermanentWidget(self.recompute_progress)
+
+        # Shown while the session file is written in the background
+        self.save_progress = QProgressBar()
+        self.save_progress.setFormat("Saving page %v of %m")
+        self.save_progress.setMaximumWidth(300)
+        self.save_progress.hide()
+        LeaderboardPro.statusBar().addPermanentWidget(self.save_progress)